@@ -1,5 +1,6 @@
-__all__ = ['induced_matrix_and_tree']
+__all__ = ['induced_matrix_and_tree', 'CompactTree']
 from dendrobites.induced_matrix_and_tree import induced_matrix_and_tree
+from dendrobites.compact_tree import CompactTree
 
 ###############################################################################
 ## PACKAGE METADATA
@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+'''A compact, array-based tree for very large (e.g. million-tip) trees.
+
+`CompactTree` stores the topology as parallel integer arrays
+(parent, first-child and next-sibling node indices), the edge lengths
+as an array of doubles and the node labels as an index into a list
+of strings. Nodes are numbered in preorder, so a parent always has
+a smaller index than its children and walking the indices backwards
+visits every node after all of its descendants.
+
+The newick reader and writer are iterative, so deep (e.g. caterpillar)
+trees do not hit the recursion limit. Labels are read as they appear
+in the file (underscores are preserved, as with the
+`preserve_underscores=True` option of dendropy) and are quoted when
+written exactly as dendropy quotes them, so labels with underscores
+survive a round trip. A leading "[&R]" or "[&U]" comment sets the
+rooting state of the tree, which is written back out; other comments
+are skipped. Only the first tree in a file is read.
+
+Trees can be converted to and from dendropy Trees with
+`CompactTree.from_dendropy` and `CompactTree.to_dendropy`.
+'''
+import re
+from array import array
+try:
+    from dendrobites.reconcile_labels import check_renamed_labels
+except ImportError:
+    from reconcile_labels import check_renamed_labels
+
+NO_NODE = -1
+NO_LABEL = -1
+_NO_LENGTH = float('nan')
+_NEWICK_TOKEN = re.compile(r"\[[^\]]*\]|'(?:[^']|'')*'|[(),:;]|[^\s(),:;\[\]']+")
+# the characters that the dendropy newick writer protects by quoting
+_NEEDS_QUOTING = re.compile(r'''[()[\]{},;:'"\0\t\n]''')
+
+def _format_label(label):
+    '''Formats `label` as the dendropy newick writer does by default: labels
+    with underscores, blanks or punctuation are quoted, and blanks in other
+    labels are written as underscores.
+    '''
+    needs_quoting = _NEEDS_QUOTING.search(label)
+    if '_' not in label and not needs_quoting:
+        return label.replace(' ', '_').replace('\t', '_')
+    return "'{}'".format(label.replace("'", "''"))
+
+class CompactTree(object):
+    '''A rooted tree stored as arrays indexed by node number.
+    Node 0 is the root. `NO_NODE` marks a missing parent, child or sibling,
+    `NO_LABEL` an unlabeled node, and NaN a missing edge length.
+    `is_rooted` is True ("[&R]"), False ("[&U]") or None (not stated),
+    like the rooting state of a dendropy Tree.
+    '''
+    def __init__(self):
+        self.is_rooted = None
+        self.parent = array('i')
+        self.first_child = array('i')
+        self.next_sibling = array('i')
+        self.edge_length = array('d')
+        self.label_index = array('i')
+        self.labels = []
+        self._last_child = array('i')
+
+    def __len__(self):
+        return len(self.parent)
+
+    def add_node(self, parent=NO_NODE, label=None, edge_length=None):
+        '''Appends a node as the last child of `parent` and returns its index.
+        Nodes must be added in preorder.
+        '''
+        nd = len(self.parent)
+        self.parent.append(parent)
+        self.first_child.append(NO_NODE)
+        self.next_sibling.append(NO_NODE)
+        self._last_child.append(NO_NODE)
+        self.edge_length.append(_NO_LENGTH if edge_length is None else edge_length)
+        self.label_index.append(NO_LABEL)
+        if label is not None:
+            self.set_label(nd, label)
+        if parent != NO_NODE:
+            prev = self._last_child[parent]
+            if prev == NO_NODE:
+                self.first_child[parent] = nd
+            else:
+                self.next_sibling[prev] = nd
+            self._last_child[parent] = nd
+        return nd
+
+    def set_label(self, nd, label):
+        self.label_index[nd] = len(self.labels)
+        self.labels.append(label)
+
+    def label(self, nd):
+        li = self.label_index[nd]
+        return None if li == NO_LABEL else self.labels[li]
+
+    def rename_labels(self, rename_map):
+        '''Replaces the leaf labels that are keys of `rename_map` by their
+        values (labels of internal nodes are left as they are). Raises a
+        ValueError if that would give two leaves the same label.'''
+        check_renamed_labels(self.leaf_labels(), rename_map)
+        labels = self.labels
+        for nd in self.leaf_indices():
+            li = self.label_index[nd]
+            if li != NO_LABEL:
+                labels[li] = rename_map.get(labels[li], labels[li])
+
+    def length(self, nd):
+        el = self.edge_length[nd]
+        return None if el != el else el
+
+    def is_leaf(self, nd):
+        return self.first_child[nd] == NO_NODE
+
+    def children(self, nd):
+        c = self.first_child[nd]
+        r = []
+        while c != NO_NODE:
+            r.append(c)
+            c = self.next_sibling[c]
+        return r
+
+    def leaf_indices(self):
+        '''Returns the indices of the leaves in preorder.'''
+        fc = self.first_child
+        return [i for i in range(len(fc)) if fc[i] == NO_NODE]
+
+    def leaf_labels(self):
+        '''Returns the labels of the leaves in preorder.'''
+        return [self.label(i) for i in self.leaf_indices()]
+
+    def induced_subtree(self, retained_labels):
+        '''Returns a new CompactTree induced by the leaves whose labels are in
+        `retained_labels`. Unifurcations are suppressed and their edge lengths
+        added to the edge below them, as `Tree.prune_taxa` does. O(n).
+        '''
+        n = len(self)
+        rep = array('i', [NO_NODE]) * n
+        el = array('d', self.edge_length)
+        for nd in range(n - 1, -1, -1):
+            c = self.first_child[nd]
+            if c == NO_NODE:
+                if self.label(nd) in retained_labels:
+                    rep[nd] = nd
+                continue
+            num_kept, only = 0, NO_NODE
+            while c != NO_NODE:
+                if rep[c] != NO_NODE:
+                    num_kept += 1
+                    only = rep[c]
+                c = self.next_sibling[c]
+            if num_kept == 1:
+                if el[nd] == el[nd]:
+                    el[only] = el[nd] if el[only] != el[only] else el[only] + el[nd]
+                rep[nd] = only
+            elif num_kept > 1:
+                rep[nd] = nd
+        if rep[0] == NO_NODE:
+            raise ValueError('None of the retained labels are attached to leaves of the tree.\n')
+        induced = CompactTree()
+        induced.is_rooted = self.is_rooted
+        stack = [(rep[0], NO_NODE)]
+        while stack:
+            nd, new_par = stack.pop()
+            new_nd = induced.add_node(new_par, label=self.label(nd))
+            induced.edge_length[new_nd] = el[nd]
+            # push reversed, so that the children are added in their original order
+            kept = [rep[c] for c in self.children(nd) if rep[c] != NO_NODE]
+            for c in reversed(kept):
+                stack.append((c, new_nd))
+        return induced
+
+    @classmethod
+    def get(cls, path=None, file=None, data=None, schema='newick'):
+        '''Reads the first tree from a newick `path`, `file` (stream) or
+        `data` (string), mimicking the `get` method of dendropy Trees.
+        '''
+        if schema.lower() != 'newick':
+            raise ValueError('CompactTree can only read "newick", not "{}".\n'.format(schema))
+        if path is not None:
+            with open(path, 'r') as inp:
+                data = inp.read()
+        elif file is not None:
+            data = file.read()
+        if data is None:
+            raise ValueError('One of path, file or data is required.\n')
+        return cls.from_newick(data)
+
+    @classmethod
+    def from_newick(cls, newick):
+        tree = cls()
+        par = NO_NODE # the node whose children are being read
+        nd = NO_NODE # the node that a label or edge length refers to
+        reading_length = False
+        for m in _NEWICK_TOKEN.finditer(newick):
+            tok = m.group(0)
+            first = tok[0]
+            if first == '[':
+                if not len(tree):
+                    comment = tok[1:-1].strip().upper()
+                    if comment == '&R':
+                        tree.is_rooted = True
+                    elif comment == '&U':
+                        tree.is_rooted = False
+                continue
+            if reading_length:
+                tree.edge_length[nd] = float(tok)
+                reading_length = False
+            elif first == '(':
+                par = tree.add_node(par)
+                nd = NO_NODE
+            elif first == ',' or first == ')':
+                if nd == NO_NODE:
+                    tree.add_node(par)
+                if first == ',':
+                    nd = NO_NODE
+                else:
+                    if par == NO_NODE:
+                        raise ValueError('Unbalanced parentheses in newick string.\n')
+                    nd, par = par, tree.parent[par]
+            elif first == ';':
+                break
+            else:
+                if nd == NO_NODE:
+                    nd = tree.add_node(par)
+                if first == ':':
+                    reading_length = True
+                elif first == "'":
+                    tree.set_label(nd, tok[1:-1].replace("''", "'"))
+                else:
+                    tree.set_label(nd, tok)
+        if par != NO_NODE:
+            raise ValueError('Unbalanced parentheses in newick string.\n')
+        if not len(tree):
+            raise ValueError('No tree found in newick string.\n')
+        return tree
+
+    def as_newick(self):
+        '''Returns the tree as a newick string (terminated by ";").'''
+        if not len(self):
+            return ';'
+        if self.is_rooted is None:
+            parts = []
+        else:
+            parts = ['[&R] ' if self.is_rooted else '[&U] ']
+        # each entry is a node to open, or the closing of a node (~index)
+        stack = [0]
+        while stack:
+            nd = stack.pop()
+            if nd < 0:
+                nd = ~nd
+                parts.append(')')
+            else:
+                if nd != 0 and parts[-1] != '(':
+                    parts.append(',')
+                c = self.first_child[nd]
+                if c != NO_NODE:
+                    parts.append('(')
+                    stack.append(~nd)
+                    stack.extend(reversed(self.children(nd)))
+                    continue
+            label = self.label(nd)
+            if label is not None:
+                parts.append(_format_label(label))
+            el = self.length(nd)
+            if el is not None:
+                parts.append(':{}'.format(el))
+        parts.append(';')
+        return ''.join(parts)
+
+    def write_to_stream(self, dest, schema='newick'):
+        if schema.lower() != 'newick':
+            raise ValueError('CompactTree can only write "newick", not "{}".\n'.format(schema))
+        dest.write(self.as_newick())
+        dest.write('\n')
+
+    def write_to_path(self, dest, schema='newick'):
+        with open(dest, 'w') as outp:
+            self.write_to_stream(outp, schema=schema)
+
+    @classmethod
+    def from_dendropy(cls, tree):
+        '''Creates a CompactTree from a dendropy Tree. Taxon labels are used for
+        nodes with taxa, and node labels for the other nodes.
+        '''
+        compact = cls()
+        if not tree.rooting_state_is_undefined:
+            compact.is_rooted = tree.is_rooted
+        node2ind = {}
+        for node in tree.preorder_node_iter():
+            parent = node.parent_node
+            par = NO_NODE if parent is None else node2ind[parent]
+            label = node.taxon.label if node.taxon is not None else node.label
+            nd = compact.add_node(par, label=label, edge_length=node.edge.length)
+            if not node.is_leaf():
+                node2ind[node] = nd
+        return compact
+
+    def to_dendropy(self, taxon_namespace=None):
+        '''Returns a dendropy Tree. Leaf labels become taxa (in `taxon_namespace`
+        if one is given) and labels of internal nodes become node labels.
+        '''
+        import dendropy
+        tree = dendropy.Tree(taxon_namespace=taxon_namespace)
+        if self.is_rooted is not None:
+            tree.is_rooted = self.is_rooted
+        tns = tree.taxon_namespace
+        # index the namespace once (rather than a linear `require_taxon` per leaf)
+        if tns.is_case_sensitive:
+            key = lambda label: label
+        else:
+            key = lambda label: label.lower()
+        label2taxon = {}
+        for taxon in tns:
+            if taxon.label is not None:
+                label2taxon.setdefault(key(taxon.label), taxon)
+        nodes = [None] * len(self)
+        for nd in range(len(self)):
+            if nd == 0:
+                node = tree.seed_node
+            else:
+                node = nodes[self.parent[nd]].new_child()
+            label = self.label(nd)
+            if label is not None:
+                if self.is_leaf(nd):
+                    taxon = label2taxon.get(key(label))
+                    if taxon is None:
+                        taxon = dendropy.Taxon(label)
+                        tns.add_taxon(taxon)
+                        label2taxon[key(label)] = taxon
+                    node.taxon = taxon
+                else:
+                    node.label = label
+            node.edge.length = self.length(nd)
+            if not self.is_leaf(nd):
+                nodes[nd] = node
+        return tree
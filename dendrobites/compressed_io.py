@@ -0,0 +1,384 @@
+#!/usr/bin/env python
+'''Transparent reading and writing of compressed files for the
+DendroBites scripts.
+
+The codec of an input file is detected from its leading "magic" bytes,
+and the codec of an output file is chosen from its extension (.bgz, .gz,
+.bz2, .xz, .zst).
+
+When a multi-threaded command line tool for the codec is on the PATH
+(bgzip, pigz, pbzip2, xz, zstd) the data are piped through it, so that
+(de)compression runs in another process and, where the format allows,
+on several cores. Otherwise the corresponding python module is used. In
+either case the data are streamed; no temporary files are written.
+
+All of these tools compress on several threads, but most gzip, bz2 and
+zstd files can only be decompressed on one: pigz and zstd always
+decompress on one thread, pbzip2 only uses several for files that it
+wrote, and xz only for files written in several blocks (e.g. by
+"xz -T"). Block-gzip (BGZF, as written by bgzip) is split into
+independent blocks, so it is decompressed on several threads: by
+"bgzip -@N" if it is on the PATH, or else by inflating the blocks with
+zlib in a pool of threads (zlib does not hold the interpreter lock
+while it works). An output name ending in .bgz is written as BGZF in
+the same way.
+'''
+import io
+import os
+import signal
+import struct
+import subprocess
+import sys
+import zlib
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
+
+# codec name -> leading bytes of a file compressed with it
+MAGIC_BYTES = (('gzip', b'\x1f\x8b'),
+               ('bz2', b'BZh'),
+               ('xz', b'\xfd7zXZ\x00'),
+               ('zstd', b'\x28\xb5\x2f\xfd'),
+              )
+EXTENSION_TO_CODEC = {'.bgz': 'bgzf',
+                      '.gz': 'gzip',
+                      '.bz2': 'bz2',
+                      '.xz': 'xz',
+                      '.zst': 'zstd',
+                     }
+
+def _default_num_threads():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+def _external_command(codec, decompress, num_threads):
+    '''Returns the argument list for a multi-threaded command line tool
+    that reads from stdin (or a file appended to the list) and writes to
+    stdout, or `None` if no such tool is available for `codec`.
+    '''
+    nt = str(num_threads)
+    if codec == 'gzip':
+        exe, args = 'pigz', ['-p', nt, '-c']
+    elif codec == 'bgzf':
+        exe, args = 'bgzip', ['-@', nt, '-c']
+    elif codec == 'bz2':
+        exe, args = 'pbzip2', ['-p' + nt, '-c']
+    elif codec == 'xz':
+        exe, args = 'xz', ['-T', nt, '-c']
+    elif codec == 'zstd':
+        exe, args = 'zstd', ['-T' + nt, '-q', '-c']
+    else:
+        return None
+    if which(exe) is None:
+        return None
+    if decompress:
+        args.insert(0, '-d')
+    return [exe] + args
+
+def _python_open(codec, path, mode, num_threads):
+    '''Opens `path` in binary `mode` with the python module for `codec`.'''
+    if codec == 'gzip':
+        import gzip
+        return gzip.GzipFile(path, mode)
+    if codec == 'bgzf':
+        if 'r' in mode:
+            return io.BufferedReader(_BgzfReader(open(path, 'rb'), num_threads, path))
+        return io.BufferedWriter(_BgzfWriter(open(path, 'wb'), num_threads))
+    if codec == 'bz2':
+        import bz2
+        return bz2.BZ2File(path, mode)
+    if codec == 'xz':
+        try:
+            import lzma
+        except ImportError:
+            raise RuntimeError('Reading or writing "{}" requires the "xz" program or the lzma module.\n'.format(path))
+        return lzma.LZMAFile(path, mode)
+    if codec == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError('Reading or writing "{}" requires the "zstd" program or the zstandard module.\n'.format(path))
+        if 'r' in mode:
+            return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+        cctx = zstandard.ZstdCompressor(threads=num_threads)
+        return cctx.stream_writer(open(path, 'wb'), closefd=True)
+    raise ValueError('Unknown compression codec "{}"'.format(codec))
+
+def _as_text(binary_stream):
+    if sys.version_info[0] < 3:
+        return binary_stream
+    return io.TextIOWrapper(binary_stream)
+
+class _PipedStream(object):
+    '''Wraps a text stream that is connected to a (de)compression
+    subprocess, so that closing the stream waits for the process and
+    reports its failure.
+    '''
+    def __init__(self, stream, proc, command, path, to_close=None, is_input=False):
+        self._stream = stream
+        self._proc = proc
+        self._command = command
+        self._path = path
+        self._to_close = to_close
+        self._is_input = is_input
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+    def __iter__(self):
+        return iter(self._stream)
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # do not let the exit status of the process hide the exception
+            self.abort()
+    def abort(self):
+        '''Stops the process and closes the streams without reporting errors.'''
+        if self._proc is None:
+            return
+        proc, self._proc = self._proc, None
+        try:
+            self._stream.close()
+        except (IOError, OSError):
+            pass
+        if proc.poll() is None:
+            proc.terminate()
+        proc.wait()
+        if self._to_close is not None:
+            self._to_close.close()
+    def close(self):
+        if self._proc is None:
+            return
+        proc, self._proc = self._proc, None
+        self._stream.close()
+        rc = proc.wait()
+        if self._to_close is not None:
+            self._to_close.close()
+        if self._is_input and rc == -signal.SIGPIPE:
+            # the reader stopped before the end of the file
+            return
+        if rc != 0:
+            emf = '"{}" exited with status {} while processing "{}"\n'
+            raise IOError(emf.format(self._command, rc, self._path))
+
+# the largest amount of data in a BGZF block, as in bgzip
+BGZF_BLOCK_SIZE = 0xff00
+# the empty block that ends a BGZF file
+BGZF_EOF = b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+
+def _bgzf_block(data):
+    '''Returns `data` (at most BGZF_BLOCK_SIZE bytes) as a BGZF block: a gzip
+    member whose "BC" extra field holds the size of the block.'''
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    header = struct.pack('<4BI2BH2sHH', 0x1f, 0x8b, 8, 4, 0, 0, 255, 6, b'BC', 2, len(cdata) + 25)
+    return header + cdata + struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
+
+class _BgzfWriter(io.RawIOBase):
+    '''A binary stream that writes BGZF to the file object `dest`. Blocks are
+    compressed in a pool of `num_threads` threads, with no more than two
+    blocks per thread waiting to be written.
+    '''
+    def __init__(self, dest, num_threads):
+        from collections import deque
+        from multiprocessing.pool import ThreadPool
+        self._dest = dest
+        self._buffer = bytearray()
+        self._num_threads = max(num_threads, 1)
+        self._pool = ThreadPool(self._num_threads) if self._num_threads > 1 else None
+        self._pending = deque()
+    def writable(self):
+        return True
+    def write(self, data):
+        self._buffer.extend(data)
+        while len(self._buffer) >= BGZF_BLOCK_SIZE:
+            self._add_block(bytes(self._buffer[:BGZF_BLOCK_SIZE]))
+            del self._buffer[:BGZF_BLOCK_SIZE]
+        return len(data)
+    def _add_block(self, data):
+        if self._pool is None:
+            self._dest.write(_bgzf_block(data))
+            return
+        self._pending.append(self._pool.apply_async(_bgzf_block, (data,)))
+        while len(self._pending) > 2*self._num_threads:
+            self._dest.write(self._pending.popleft().get())
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._buffer:
+                self._add_block(bytes(self._buffer))
+                self._buffer = bytearray()
+            while self._pending:
+                self._dest.write(self._pending.popleft().get())
+            self._dest.write(BGZF_EOF)
+        finally:
+            if self._pool is not None:
+                self._pool.terminate()
+            self._dest.close()
+            io.RawIOBase.close(self)
+
+def _is_bgzf_header(head):
+    '''Returns True if the bytes `head` start with a gzip header that has the
+    "BC" extra field of BGZF as its first subfield.'''
+    if len(head) < 16:
+        return False
+    id1, id2, cm, flg, xlen, si = struct.unpack('<4B6xH2s', head[:14])
+    return (flg & 4) != 0 and xlen >= 6 and si == b'BC'
+
+def _inflate_bgzf_block(block):
+    cdata, crc, size, path = block
+    data = zlib.decompress(cdata, -15)
+    if len(data) != size or (zlib.crc32(data) & 0xffffffff) != crc:
+        raise IOError('Corrupt BGZF block in "{}"\n'.format(path))
+    return data
+
+class _BgzfReader(io.RawIOBase):
+    '''A binary stream of the data in the BGZF file object `src`. Blocks are
+    inflated in a pool of `num_threads` threads, reading no more than two
+    blocks per thread ahead of the data returned.
+    '''
+    def __init__(self, src, num_threads, path):
+        from collections import deque
+        from multiprocessing.pool import ThreadPool
+        self._src = src
+        self._path = path
+        self._num_threads = max(num_threads, 1)
+        self._pool = ThreadPool(self._num_threads) if self._num_threads > 1 else None
+        self._pending = deque()
+        self._at_end = False
+        self._data = b''
+        self._offset = 0
+    def readable(self):
+        return True
+    def _read_block(self):
+        '''Returns (compressed data, CRC, size, path) of the next block, or
+        None at the end of the file.'''
+        head = self._src.read(12)
+        if not head:
+            return None
+        if len(head) < 12:
+            raise IOError('Truncated BGZF block in "{}"\n'.format(self._path))
+        id1, id2, cm, flg, xlen = struct.unpack('<4B6xH', head)
+        if (id1, id2, cm) != (0x1f, 0x8b, 8) or not (flg & 4):
+            raise IOError('"{}" is not a BGZF file\n'.format(self._path))
+        extra = self._src.read(xlen)
+        bsize = None
+        pos = 0
+        while pos + 4 <= len(extra):
+            si, slen = struct.unpack('<2sH', extra[pos:pos + 4])
+            if si == b'BC' and slen == 2:
+                bsize = struct.unpack('<H', extra[pos + 4:pos + 6])[0]
+            pos += 4 + slen
+        if bsize is None:
+            raise IOError('"{}" is not a BGZF file\n'.format(self._path))
+        rest = self._src.read(bsize + 1 - 12 - xlen)
+        if len(rest) != bsize + 1 - 12 - xlen or len(rest) < 8:
+            raise IOError('Truncated BGZF block in "{}"\n'.format(self._path))
+        crc, size = struct.unpack('<II', rest[-8:])
+        return rest[:-8], crc, size, self._path
+    def _next_data(self):
+        '''Returns the data of the next block, or None at the end of the file.'''
+        if self._pool is None:
+            block = self._read_block()
+            return None if block is None else _inflate_bgzf_block(block)
+        while not self._at_end and len(self._pending) < 2*self._num_threads:
+            block = self._read_block()
+            if block is None:
+                self._at_end = True
+            else:
+                self._pending.append(self._pool.apply_async(_inflate_bgzf_block, (block,)))
+        if not self._pending:
+            return None
+        return self._pending.popleft().get()
+    def readinto(self, b):
+        while self._offset >= len(self._data):
+            data = self._next_data()
+            if data is None:
+                return 0
+            self._data, self._offset = data, 0
+        n = min(len(b), len(self._data) - self._offset)
+        b[:n] = self._data[self._offset:self._offset + n]
+        self._offset += n
+        return n
+    def close(self):
+        if self.closed:
+            return
+        if self._pool is not None:
+            self._pool.terminate()
+        self._src.close()
+        io.RawIOBase.close(self)
+
+def codec_from_extension(path):
+    '''Returns the codec name implied by the extension of `path`
+    or `None` for an uncompressed file.
+    '''
+    return EXTENSION_TO_CODEC.get(os.path.splitext(path)[1].lower())
+
+def detect_codec(path):
+    '''Returns the codec name for the existing file at `path` (based on
+    its leading bytes) or `None` if the file is not compressed.
+    '''
+    with open(path, 'rb') as inp:
+        head = inp.read(16)
+    for codec, magic in MAGIC_BYTES:
+        if head.startswith(magic):
+            if codec == 'gzip' and _is_bgzf_header(head):
+                return 'bgzf'
+            return codec
+    return None
+
+def open_input(path, num_threads=None):
+    '''Returns a text stream of the (possibly compressed) file at `path`.'''
+    codec = detect_codec(path)
+    if codec is None:
+        return open(path, 'r')
+    if num_threads is None:
+        num_threads = _default_num_threads()
+    cmd = _external_command(codec, decompress=True, num_threads=num_threads)
+    if cmd is None:
+        return _as_text(_python_open(codec, path, 'rb', num_threads))
+    proc = subprocess.Popen(cmd + [path], stdout=subprocess.PIPE)
+    return _PipedStream(_as_text(proc.stdout), proc, cmd[0], path, is_input=True)
+
+def open_output(path, num_threads=None):
+    '''Returns a text stream that writes to `path`, compressed according
+    to the file extension of `path`.
+    '''
+    codec = codec_from_extension(path)
+    if codec is None:
+        return open(path, 'w')
+    if num_threads is None:
+        num_threads = _default_num_threads()
+    cmd = _external_command(codec, decompress=False, num_threads=num_threads)
+    if cmd is None:
+        return _as_text(_python_open(codec, path, 'wb', num_threads))
+    outp = open(path, 'wb')
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=outp)
+    return _PipedStream(_as_text(proc.stdin), proc, cmd[0], path, to_close=outp)
+
+def read_from_path(data_type, path, schema, num_threads=None, **kwargs):
+    '''Calls `data_type.get` (e.g. `Tree.get` or `DnaCharacterMatrix.get`)
+    on the (possibly compressed) file at `path`, decompressing it on
+    `num_threads` threads (default: one per CPU).
+    '''
+    if detect_codec(path) is None:
+        return data_type.get(path=path, schema=schema, **kwargs)
+    with open_input(path, num_threads=num_threads) as inp:
+        return data_type.get(file=inp, schema=schema, **kwargs)
+
+def write_to_path(data_object, path, schema, num_threads=None, **kwargs):
+    '''Writes `data_object` (a dendropy Tree, CharacterMatrix...) to `path`
+    compressing it (on `num_threads` threads, default: one per CPU) if the
+    extension of `path` calls for compression.
+    '''
+    if codec_from_extension(path) is None:
+        data_object.write_to_path(path, schema=schema, **kwargs)
+        return
+    with open_output(path, num_threads=num_threads) as outp:
+        data_object.write_to_stream(outp, schema=schema, **kwargs)
@@ -10,9 +10,23 @@ This identifies sites that are potentially clean synapomorphies
 for the listed taxa.
 
 Cells with missing data in the matrix are ignored. 
+
+With --format tsv or json, each column is reported with its support
+statistics (see `iter_synapo_column_stats`) as soon as it is found, and
+with --top-k only the best scoring columns are kept and reported.
 '''
+import heapq
+import json
 from dendropy.datamodel.charmatrixmodel import data_type_matrix_map, \
                                                DnaCharacterMatrix
+try:
+    xrange
+except NameError:
+    xrange = range # python 3
+try:
+    from dendrobites.compressed_io import read_from_path
+except ImportError:
+    from compressed_io import read_from_path
 
 def iter_columns(char_mat, taxa_order=None):
     '''Iterates through the columns of a `char_mat`. Returning 
@@ -33,7 +47,11 @@ def iter_columns(char_mat, taxa_order=None):
         yield column
 
 def find_potential_synapo_columns(char_mat, ingroup_taxa):
-    r = []
+    return list(iter_potential_synapo_columns(char_mat, ingroup_taxa))
+
+def iter_potential_synapo_columns(char_mat, ingroup_taxa):
+    '''Yields the [col_ind, in_states, out_states] lists of
+    `find_potential_synapo_columns` one at a time.'''
     all_taxa = char_mat.taxon_namespace
     for col_ind, column in enumerate(iter_columns(char_mat)):
         in_c = set()
@@ -57,23 +75,99 @@ def find_potential_synapo_columns(char_mat, ingroup_taxa):
                 else:
                     out_c.add(symbol)
         if are_disjunct and bool(in_c) and bool(out_c):
-            r.append([col_ind, in_c, out_c])
-    return r
+            yield [col_ind, in_c, out_c]
 
-def _main(char_mat_filepath,
-          data_type_name,
-          taxa_identifiers,
-          schema='nexus'):
-    # Validate the data_type argument and use it to find the CharacterMatrix type
-    dt = data_type_name.lower()
-    mat_type = data_type_matrix_map.get(dt)
-    if mat_type is None:
-        emf = 'The data type "{u}" is not recognized.\nExpecting one of "{t}".\n'
-        k = data_type_matrix_map.keys()
-        k.sort()
-        raise ValueError(emf.format(u=data_type_name, t='", "'.join(k)))
-    # read the char matrix 
-    char_mat = mat_type.get(path=char_mat_filepath, schema=schema)
+SYNAPO_STATS_FIELDS = ['column',
+                       'score',
+                       'in_coverage',
+                       'out_coverage',
+                       'num_non_missing',
+                       'in_states',
+                       'out_states',
+                       'state_counts']
+
+def iter_synapo_column_stats(char_mat, ingroup_taxa):
+    '''Yields a dict of support statistics for each column that
+    `find_potential_synapo_columns` would report, in the same single pass
+    over the columns:
+        "column" -- the column index
+        "in_coverage", "out_coverage" -- the fraction of the ingroup
+            (outgroup) taxa with a non-missing, single state cell
+        "num_non_missing" -- the number of such cells
+        "in_states", "out_states" -- sorted lists of their states
+        "state_counts" -- dict of state -> number of cells
+        "score" -- in_coverage*out_coverage/(number of in states), so that
+            columns scored for most taxa, with one ingroup state, rank first.
+    '''
+    taxa_order = [i for i in char_mat]
+    is_in = [i in ingroup_taxa for i in taxa_order]
+    num_in = sum(is_in)
+    num_out = len(is_in) - num_in
+    for col_ind, column in enumerate(iter_columns(char_mat, taxa_order)):
+        in_counts = {}
+        out_counts = {}
+        are_disjunct = True
+        for tax_ind, cell in enumerate(column):
+            if cell.is_gap_state or (not cell.is_single_state):
+                continue
+            symbol = cell.symbol
+            if is_in[tax_ind]:
+                if symbol in out_counts:
+                    are_disjunct = False
+                    break
+                in_counts[symbol] = in_counts.get(symbol, 0) + 1
+            else:
+                if symbol in in_counts:
+                    are_disjunct = False
+                    break
+                out_counts[symbol] = out_counts.get(symbol, 0) + 1
+        if are_disjunct and in_counts and out_counts:
+            num_scored_in = sum(in_counts.values())
+            num_scored_out = sum(out_counts.values())
+            in_coverage = num_scored_in/float(num_in)
+            out_coverage = num_scored_out/float(num_out)
+            state_counts = dict(in_counts)
+            state_counts.update(out_counts)
+            yield {'column': col_ind,
+                   'score': in_coverage*out_coverage/len(in_counts),
+                   'in_coverage': in_coverage,
+                   'out_coverage': out_coverage,
+                   'num_non_missing': num_scored_in + num_scored_out,
+                   'in_states': sorted(in_counts.keys()),
+                   'out_states': sorted(out_counts.keys()),
+                   'state_counts': state_counts}
+
+def top_k_synapo_columns(column_stats, k):
+    '''Returns the `k` highest scoring of the `column_stats` dicts (best first,
+    ties in column order), keeping only `k` of them in memory.'''
+    return heapq.nlargest(k, column_stats, key=lambda stats: stats['score'])
+
+def write_synapo_stats_tsv(column_stats, dest):
+    '''Writes a header and a tab-separated line (see SYNAPO_STATS_FIELDS) for
+    each of the `column_stats` dicts to `dest` as they are produced.'''
+    dest.write('\t'.join(SYNAPO_STATS_FIELDS) + '\n')
+    for stats in column_stats:
+        counts = stats['state_counts']
+        dest.write('{}\t{:.6g}\t{:.6g}\t{:.6g}\t{}\t{}\t{}\t{}\n'.format(stats['column'],
+                                                                         stats['score'],
+                                                                         stats['in_coverage'],
+                                                                         stats['out_coverage'],
+                                                                         stats['num_non_missing'],
+                                                                         ','.join(stats['in_states']),
+                                                                         ','.join(stats['out_states']),
+                                                                         ';'.join('{}={}'.format(i, counts[i]) for i in sorted(counts.keys()))))
+
+def write_synapo_stats_json_lines(column_stats, dest):
+    '''Writes each of the `column_stats` dicts to `dest` as a line of JSON
+    as they are produced.'''
+    for stats in column_stats:
+        dest.write(json.dumps(stats, sort_keys=True) + '\n')
+
+def find_ingroup_taxa(char_mat, taxa_identifiers):
+    '''Returns a frozenset of the taxa in the namespace of `char_mat` whose
+    labels are listed in `taxa_identifiers`. Raises a ValueError if the
+    labels are repeated, not found, or name every taxon.
+    '''
     tns = char_mat.taxon_namespace
     nt = len(tns)
     rts = set(taxa_identifiers)
@@ -83,15 +177,49 @@ def _main(char_mat_filepath,
     if len(ingroup_taxa) != len(taxa_identifiers):
         fts = {i.label for i in ingroup_taxa}
         msg = '", "'.join([i for i in rts - fts])
-        raise ValueError('Could not find the taxa labels: "{}"'.format())
+        raise ValueError('Could not find the taxa labels: "{}"'.format(msg))
     if len(ingroup_taxa) == nt:
         raise ValueError('Listing all tips is nonsensical')
-    psc = find_potential_synapo_columns(char_mat, ingroup_taxa)
+    return ingroup_taxa
+
+def write_potential_synapo_columns(psc, dest):
+    '''Writes the [col_ind, in_states, out_states] lists returned by
+    `find_potential_synapo_columns` to the stream `dest`.
+    '''
     for el in psc:
         col_in, in_states, out_states = el
-        sys.stdout.write('Column {}: in states = {{{}}}. out states = {{{}}}.\n'.format(col_in,
-                                                                                ', '.join([i for i in in_states]),
-                                                                                ', '.join([i for i in out_states])))
+        dest.write('Column {}: in states = {{{}}}. out states = {{{}}}.\n'.format(col_in,
+                                                                             ', '.join([i for i in in_states]),
+                                                                             ', '.join([i for i in out_states])))
+
+def _main(char_mat_filepath,
+          data_type_name,
+          taxa_identifiers,
+          schema='nexus',
+          output_format='text',
+          top_k=None):
+    # Validate the data_type argument and use it to find the CharacterMatrix type
+    dt = data_type_name.lower()
+    mat_type = data_type_matrix_map.get(dt)
+    if mat_type is None:
+        emf = 'The data type "{u}" is not recognized.\nExpecting one of "{t}".\n'
+        k = data_type_matrix_map.keys()
+        k.sort()
+        raise ValueError(emf.format(u=data_type_name, t='", "'.join(k)))
+    # read the char matrix 
+    char_mat = read_from_path(mat_type, char_mat_filepath, schema=schema)
+    ingroup_taxa = find_ingroup_taxa(char_mat, taxa_identifiers)
+    if output_format == 'text' and top_k is None:
+        write_potential_synapo_columns(iter_potential_synapo_columns(char_mat, ingroup_taxa), sys.stdout)
+        return
+    column_stats = iter_synapo_column_stats(char_mat, ingroup_taxa)
+    if top_k is not None:
+        column_stats = top_k_synapo_columns(column_stats, top_k)
+    if output_format == 'json':
+        write_synapo_stats_json_lines(column_stats, sys.stdout)
+    else:
+        write_synapo_stats_tsv(column_stats, sys.stdout)
+
 if __name__ == '__main__':
     import argparse
     import sys
@@ -102,11 +230,19 @@ if __name__ == '__main__':
     parser.add_argument('--data-type', default='dna', type=str, required=False, help='a data_type. Default is "dna"')
     parser.add_argument('--char-mat', type=str, required=True, help='A filepath for the input file')
     parser.add_argument('--schema', default='nexus', type=str, required=False, help='A file format name. Default is "nexus"')
+    parser.add_argument('--format', default='text', choices=['text', 'tsv', 'json'], required=False, help='"text", or "tsv" or "json" (one object per line) for the columns with their support statistics. Default is "text"')
+    parser.add_argument('--top-k', default=None, type=int, required=False, help='report only the K best scoring columns, best first (as "tsv" unless --format json)')
     parser.add_argument('taxa', default=None, nargs='+', help='list of taxon names for the group whose synapomorphies that you want to find')
     args = parser.parse_args(sys.argv[1:])
     try:
         assert len(args.taxa) > 0
-        _main(args.char_mat, args.data_type, taxa_identifiers=args.taxa, schema=args.schema)
+        assert args.top_k is None or args.top_k > 0
+        _main(args.char_mat,
+              args.data_type,
+              taxa_identifiers=args.taxa,
+              schema=args.schema,
+              output_format=args.format,
+              top_k=args.top_k)
     except Exception as x:
         raise
         sys.exit('{}: {}\n'.format(script_name, str(x)))
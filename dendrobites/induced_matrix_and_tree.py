@@ -5,51 +5,190 @@ prune the same set of removed taxa from a data matrix.
 from dendropy import Tree
 from dendropy.datamodel.charmatrixmodel import data_type_matrix_map, \
                                                DnaCharacterMatrix
+try:
+    from dendrobites.compressed_io import read_from_path, write_to_path
+except ImportError:
+    from compressed_io import read_from_path, write_to_path
+try:
+    from dendrobites.compact_tree import CompactTree
+except ImportError:
+    from compact_tree import CompactTree
+try:
+    from dendrobites.reconcile_labels import apply_rename_map, read_rename_map
+except ImportError:
+    from reconcile_labels import apply_rename_map, read_rename_map
+
 def read_matrix_and_tree(char_file_path,
                          tree_file_path,
                          char_type=DnaCharacterMatrix,
                          char_schema='fasta',
-                         tree_schema='newick'):
+                         tree_schema='newick',
+                         rename_map=None):
+    '''Reads an (optional) CharacterMatrix and a tree that shares its taxon
+    namespace. If a `rename_map` (old label -> new label) is given, the
+    taxa of the matrix are relabeled before the tree is read (or those of
+    the tree, if there is no matrix).
+    '''
     if char_file_path:
-        d = char_type.get(path=char_file_path, schema=char_schema)
+        d = read_from_path(char_type, char_file_path, schema=char_schema)
         tn = d.taxon_namespace
+        if rename_map:
+            apply_rename_map(tn, rename_map)
         tn.is_mutable = False
     else:
         d, tn = None, None
-    tree = Tree.get(path=tree_file_path,
-                    schema=tree_schema,
-                    preserve_underscores=True,
-                    taxon_namespace=tn)
+    tree = read_from_path(Tree,
+                          tree_file_path,
+                          schema=tree_schema,
+                          preserve_underscores=True,
+                          taxon_namespace=tn)
+    if rename_map and d is None:
+        apply_rename_map(tree.taxon_namespace, rename_map)
     return d, tree
 
+def _add_edge_length(node, length):
+    if length is not None:
+        if node.edge.length is None:
+            node.edge.length = length
+        else:
+            node.edge.length += length
+
+def prune_to_induced_tree(tree, retained_taxa):
+    '''Modifies `tree` in place so that it is the tree induced by the leaves
+    whose taxa are in `retained_taxa`. Returns the tree.
+
+    This produces the same tree as `tree.prune_taxa` called with every
+    other taxon, but it visits each node once: in a postorder pass, each
+    node is replaced by the node that represents it in the induced tree
+    (itself, its only retained descendant if it would become a
+    unifurcation, or `None` if none of its leaves are retained). The
+    edge lengths of suppressed nodes are added to their representative.
+    '''
+    rep = {}
+    for nd in list(tree.postorder_node_iter()):
+        kept = []
+        is_changed = False
+        for child in nd.child_nodes():
+            c_rep = rep.pop(child)
+            if c_rep is None or c_rep is not child:
+                is_changed = True
+            if c_rep is not None:
+                kept.append(c_rep)
+        if len(kept) == 1:
+            only = kept[0]
+            _add_edge_length(only, nd.edge.length)
+            rep[nd] = only
+            continue
+        if is_changed:
+            nd.set_child_nodes(kept)
+        if kept or (nd.taxon is not None and nd.taxon in retained_taxa):
+            rep[nd] = nd
+        else:
+            rep[nd] = None
+    root = rep.pop(tree.seed_node)
+    if root is None:
+        raise ValueError('None of the retained taxa are attached to leaves of the tree.\n')
+    if root is not tree.seed_node:
+        root.parent_node = None
+        tree.seed_node = root
+    return tree
+
 def induced_matrix_and_tree(char_mat_filepath,
                             tree_filepath,
                             taxa_labels,
                             char_type=DnaCharacterMatrix,
                             char_schema='fasta',
-                            tree_schema='newick'):
+                            tree_schema='newick',
+                            single_pass=False,
+                            compact_tree=False,
+                            rename_map=None):
     '''Reads an (optional) CharacterMatrix from `char_mat_filepath` and
     a (required) tree from `tree_filepath`. Prunes both down to just
     the taxa whose labels match `taxa_labels` and then returns (char_mat, tree).
+
+    If `single_pass` is True, the tree is pruned by `prune_to_induced_tree`
+    (linear in the size of the tree) rather than by `Tree.prune_taxa`.
+
+    If `compact_tree` is True, the (newick) tree is read, pruned and returned
+    as a CompactTree, which uses far less memory than a dendropy Tree.
+
+    `rename_map` (old label -> new label) is applied while reading, as
+    described for `read_matrix_and_tree`.
     '''
+    if compact_tree:
+        return _induced_matrix_and_compact_tree(char_mat_filepath,
+                                                tree_filepath,
+                                                taxa_labels,
+                                                char_type=char_type,
+                                                char_schema=char_schema,
+                                                tree_schema=tree_schema,
+                                                rename_map=rename_map)
     # read the char matrix and tree....
     char_mat, tree = read_matrix_and_tree(char_mat_filepath,
                                           tree_filepath,
                                           char_type=char_type,
                                           char_schema=char_schema,
-                                          tree_schema=tree_schema)
+                                          tree_schema=tree_schema,
+                                          rename_map=rename_map)
+    return prune_matrix_and_tree(char_mat, tree, taxa_labels, single_pass=single_pass)
+
+def prune_matrix_and_tree(char_mat, tree, taxa_labels, single_pass=False):
+    '''Prunes an (optional) CharacterMatrix `char_mat` and an (optional) tree
+    that share a taxon namespace down to the taxa whose labels match
+    `taxa_labels`. Both are modified in place. Returns (char_mat, tree).
+    '''
+    taxon_namespace = tree.taxon_namespace if tree is not None else char_mat.taxon_namespace
     taxa_labels = frozenset(taxa_labels)
-    if not tree.taxon_namespace.has_taxa_labels(taxa_labels):
+    if not taxon_namespace.has_taxa_labels(taxa_labels):
         for t in taxa_labels:
-            if not tree.taxon_namespace.has_taxon_label(t):
+            if not taxon_namespace.has_taxon_label(t):
                 raise ValueError('Taxon "{}" not found in the taxon namespace of this data.\n'.format(t))
     to_cull = []
-    for t in tree.taxon_namespace:
+    for t in taxon_namespace:
         if t.label not in taxa_labels:
             to_cull.append(t)
     if to_cull:
-        tree.prune_taxa(to_cull)
+        if tree is not None:
+            if single_pass:
+                retained = frozenset(t for t in taxon_namespace if t.label in taxa_labels)
+                prune_to_induced_tree(tree, retained)
+            else:
+                tree.prune_taxa(to_cull)
+        if char_mat:
+            char_mat.remove_sequences(to_cull)
+    return char_mat, tree
+
+def _induced_matrix_and_compact_tree(char_mat_filepath,
+                                     tree_filepath,
+                                     taxa_labels,
+                                     char_type=DnaCharacterMatrix,
+                                     char_schema='fasta',
+                                     tree_schema='newick',
+                                     rename_map=None):
+    if char_mat_filepath:
+        char_mat = read_from_path(char_type, char_mat_filepath, schema=char_schema)
+        if rename_map:
+            apply_rename_map(char_mat.taxon_namespace, rename_map)
+        known_labels = set(t.label for t in char_mat.taxon_namespace)
+    else:
+        char_mat, known_labels = None, set()
+    tree = read_from_path(CompactTree, tree_filepath, schema=tree_schema)
+    if rename_map and char_mat is None:
+        tree.rename_labels(rename_map)
+    leaf_labels = tree.leaf_labels()
+    if char_mat:
+        for t in leaf_labels:
+            if t not in known_labels:
+                raise ValueError('Taxon "{}" in the tree is not in the character matrix.\n'.format(t))
+    known_labels.update(leaf_labels)
+    taxa_labels = frozenset(taxa_labels)
+    for t in taxa_labels:
+        if t not in known_labels:
+            raise ValueError('Taxon "{}" not found in the taxon namespace of this data.\n'.format(t))
+    if not known_labels.issubset(taxa_labels):
+        tree = tree.induced_subtree(taxa_labels)
         if char_mat:
+            to_cull = [t for t in char_mat.taxon_namespace if t.label not in taxa_labels]
             char_mat.remove_sequences(to_cull)
     return char_mat, tree
 
@@ -63,7 +202,10 @@ def _main(char_mat_filepath,
           taxa_labels,
           data_type_name,
           char_schema='fasta',
-          tree_schema='newick'):
+          tree_schema='newick',
+          single_pass=False,
+          compact_tree=False,
+          rename_map_filepath=None):
     # Validate the data_type argument and use it to find the CharacterMatrix type
     dt = data_type_name.lower()
     mat_type = data_type_matrix_map.get(dt)
@@ -82,16 +224,20 @@ def _main(char_mat_filepath,
     for ofp in out_paths:
         if os.path.exists(ofp):
             raise RuntimeError('"{}" already exists! Move it before running this script.\n'.format(ofp))
+    rename_map = read_rename_map(rename_map_filepath) if rename_map_filepath else None
     # read the char matrix and tree....
     char_mat, tree = induced_matrix_and_tree(char_mat_filepath,
                                              tree_filepath,
                                              taxa_labels,
                                              char_type=mat_type,
                                              char_schema=char_schema,
-                                             tree_schema=tree_schema)
-    tree.write_to_path(out_tree, schema=tree_schema)
+                                             tree_schema=tree_schema,
+                                             single_pass=single_pass,
+                                             compact_tree=compact_tree,
+                                             rename_map=rename_map)
+    write_to_path(tree, out_tree, schema=tree_schema)
     if char_mat:
-        char_mat.write_to_path(out_char, schema=char_schema)
+        write_to_path(char_mat, out_char, schema=char_schema)
 
 if __name__ == '__main__':
     import argparse
@@ -100,14 +246,18 @@ if __name__ == '__main__':
     script_name = os.path.split(sys.argv[0])[1]
     description = '''Takes a data file and a tree and a series of taxon labels.
 Writes pruned versions of the matrix and tree out to files with a "pruned-" prefix
-and the same ending as the input files.'''
+and the same ending as the input files. Inputs may be compressed (gzip, bzip2, xz
+or zstd); outputs are compressed if the input filename has a compression suffix.'''
     parser = argparse.ArgumentParser(prog=script_name, description=description)
     parser.add_argument('--data-type', default='dna', type=str, required=False, help='a data_type. Default is "dna"')
     parser.add_argument('--char', default=None, type=str, required=False, help='filepath of the character data')
     parser.add_argument('--tree', default=None, type=str, required=Tree, help='filepath of the tree')
+    parser.add_argument('--single-pass', action='store_true', default=False, help='prune the tree in one linear-time pass (faster for large trees)')
+    parser.add_argument('--compact-tree', action='store_true', default=False, help='hold the (newick) tree in a compact array-based form (for very large trees)')
+    parser.add_argument('--rename-map', default=None, type=str, required=False, help='filepath of a tab-separated map of old to new labels (see tip_label_match.py --reconcile) applied to the matrix while reading')
     parser.add_argument('taxa', nargs='+')
     args = parser.parse_args(sys.argv[1:])
     try:
-        _main(args.char, args.tree, args.taxa, args.data_type)
+        _main(args.char, args.tree, args.taxa, args.data_type, single_pass=args.single_pass, compact_tree=args.compact_tree, rename_map_filepath=args.rename_map)
     except Exception as x:
         sys.exit('{}: {}\n'.format(script_name, str(x)))
@@ -1,9 +1,13 @@
 #!/usr/bin/env python
 import dendropy
 from dendropy.calculate.phylogeneticdistance import PhylogeneticDistanceMatrix as DendropyDistMat
+try:
+    from dendrobites.compressed_io import open_input, read_from_path, write_to_path
+except ImportError:
+    from compressed_io import open_input, read_from_path, write_to_path
 def parse_distances(fn):
     mat = {}
-    with open(fn, 'rU') as inp:
+    with open_input(fn) as inp:
         for line in inp:
             bogus, first, second, n, dist = line.strip().split()
             f, s = int(first), int(second)
@@ -11,13 +15,377 @@ def parse_distances(fn):
             mat.setdefault(f, {})[s] = d
             mat.setdefault(s, {})[f] = d
     return mat
-def _main(jkk_ssv_filepath):
+def _main(jkk_ssv_filepath,
+          tree_filepath=None,
+          output_filepath=None,
+          search_radius=4,
+          max_residual=None):
     # parse to a dict of dicts with integer "names" as the keys
     dist_mat = parse_distances(jkk_ssv_filepath)
+    if tree_filepath:
+        tree = read_from_path(dendropy.Tree, tree_filepath, schema='newick', preserve_underscores=True)
+        nj, was_rebuilt = extend_nj_tree(tree,
+                                         dist_mat,
+                                         search_radius=search_radius,
+                                         max_residual=max_residual)
+        if was_rebuilt:
+            sys.stderr.write('The placement residual exceeded {}, so the NJ tree was rebuilt.\n'.format(max_residual))
+    else:
+        nj = nj_tree_from_distances(dist_mat)
+    if output_filepath:
+        write_to_path(nj, output_filepath, schema='newick')
+    else:
+        nj.print_plot(plot_metric='length')
+
+def nj_tree_from_distances(dist_mat):
+    '''Returns the neighbor-joining tree for a distance matrix
+    expressed as a dict of dicts.'''
     # Convert it to a special PhylogeneticDistanceMatrix from dendropy
     dendropy_dist = convert_to_dendropy_dist(dist_mat)
-    nj = dendropy_dist.nj_tree(is_weighted_edge_distances=True)
-    nj.print_plot(plot_metric='length')
+    return dendropy_dist.nj_tree(is_weighted_edge_distances=True)
+
+def p_distances(char_mat):
+    '''Returns the uncorrected proportion of differing sites between
+    each pair of sequences in `char_mat` as a dict of dicts keyed
+    by taxon label. Only sites at which both sequences have a single,
+    non-gap state are compared.
+    '''
+    rows = []
+    for taxon in char_mat:
+        syms = [None if (c.is_gap_state or not c.is_single_state) else c.symbol for c in char_mat[taxon]]
+        rows.append((taxon.label, syms))
+    mat = {}
+    for i, (f, f_syms) in enumerate(rows):
+        for s, s_syms in rows[:i]:
+            n, diff = 0, 0
+            for a, b in zip(f_syms, s_syms):
+                if a is not None and b is not None:
+                    n += 1
+                    if a != b:
+                        diff += 1
+            d = diff/float(n) if n else 0.0
+            mat.setdefault(f, {})[s] = d
+            mat.setdefault(s, {})[f] = d
+    return mat
+
+def _edge_len(node):
+    el = node.edge.length
+    return 0.0 if el is None else el
+
+def _weight(dist):
+    '''The weight of a distance in the placement fits: 1/dist^2, as in
+    the Fitch-Margoliash criterion, so that long (noisy) distances count
+    for less than short ones.'''
+    return 1.0/(dist*dist) if dist > 0.0 else 1e12
+
+def _shift(stats, length):
+    '''Moves the (weight, weighted sum, weighted sum of squares) of the
+    residuals of a set of leaves (new-leaf distance minus path length)
+    `length` further away.'''
+    n, s, q = stats
+    return n, s - n*length, q - 2.0*length*s + n*length*length
+
+def _add(first, second):
+    return first[0] + second[0], first[1] + second[1], first[2] + second[2]
+
+def _ls_fit(below, above, el):
+    '''Weighted least-squares placement of a new leaf on an edge of length
+    `el`. `below` and `above` are the (weight, weighted sum, weighted sum of
+    squares) of the residuals of the leaves on either side, measured from
+    the ends of the edge. Returns (weighted sum of squared errors, distance
+    of the attachment point above the lower end, pendant edge length), for
+    the best fit with 0 <= t <= el and b >= 0.
+    '''
+    nb, sb, qb = below
+    na, sa, qa = above
+    # fit b + t to the "below" residuals and b + el - t to the "above" ones
+    def sse(t, b):
+        mb, ma = b + t, b + el - t
+        return qb - 2.0*mb*sb + nb*mb*mb + qa - 2.0*ma*sa + na*ma*ma
+    alpha = sb/nb
+    beta = sa/na if na else alpha
+    t = (alpha - beta + el)/2.0
+    b = (alpha + beta - el)/2.0
+    if 0.0 <= t <= el and b >= 0.0:
+        fits = [(t, b)]
+    else:
+        # the optimum of this convex quadratic over 0 <= t <= el, b >= 0 is on
+        # the boundary: the best b at either end of the edge, or the best t for b = 0
+        b_at = lambda t: max((sb - nb*t + sa - na*(el - t))/(nb + na), 0.0)
+        t_at_zero_b = min(max((sb - sa + na*el)/(nb + na), 0.0), el)
+        fits = [(0.0, b_at(0.0)), (el, b_at(el)), (t_at_zero_b, 0.0)]
+    best = min((sse(t, b), t, b) for t, b in fits)
+    return max(best[0], 0.0), best[1], best[2]
+
+def _best_placement(tree, dist_to_new):
+    '''Returns (sse, node, t, b) for the edge (above node) with the best
+    weighted least-squares placement (see `_ls_fit`) of a new leaf whose
+    distances to the leaves of `tree` are in the dict `dist_to_new`. The
+    fits of all of the edges are found with one postorder and one preorder
+    pass over the tree.
+    '''
+    # residual sums of the leaves below each node, measured from the node
+    down = {}
+    for nd in tree.postorder_node_iter():
+        if nd.is_leaf():
+            d = dist_to_new[nd]
+            w = _weight(d)
+            down[nd] = (w, w*d, w*d*d)
+        else:
+            stats = (0, 0.0, 0.0)
+            for child in nd.child_nodes():
+                stats = _add(stats, _shift(down[child], _edge_len(child)))
+            down[nd] = stats
+    # residual sums of the leaves that are not below each node, measured from its parent
+    up = {}
+    best = None
+    for nd in tree.preorder_node_iter():
+        if nd.is_leaf():
+            continue
+        children = nd.child_nodes()
+        shifted = [_shift(down[child], _edge_len(child)) for child in children]
+        total = (0, 0.0, 0.0)
+        if nd in up:
+            total = _shift(up.pop(nd), _edge_len(nd))
+        for stats in shifted:
+            total = _add(total, stats)
+        for child, stats in zip(children, shifted):
+            n, s, q = total
+            up[child] = (n - stats[0], s - stats[1], q - stats[2])
+            sse, t, b = _ls_fit(down[child], up[child], _edge_len(child))
+            if best is None or sse < best[0]:
+                best = (sse, child, t, b)
+    return best
+
+def _nodes_within(start, radius):
+    '''Returns the nodes within `radius` edges of `start`, closest first.'''
+    seen = set([start])
+    r = [start]
+    frontier = [start]
+    for step in range(radius):
+        nxt = []
+        for nd in frontier:
+            neighbors = list(nd.child_nodes())
+            if nd.parent_node is not None:
+                neighbors.append(nd.parent_node)
+            for nb in neighbors:
+                if nb not in seen:
+                    seen.add(nb)
+                    nxt.append(nb)
+        r.extend(nxt)
+        frontier = nxt
+    return r
+
+def _closest_below(nd, below):
+    return min(((below[c][0] + _edge_len(c), below[c][1]) for c in nd.child_nodes()),
+               key=lambda x: x[0])
+
+def _closest_above_children(nd, below, above):
+    '''Yields (child, (path length, leaf)) for the closest leaf that is not
+    below each child of `nd`.'''
+    children = nd.child_nodes()
+    for child in children:
+        cands = [(below[c][0] + _edge_len(c), below[c][1]) for c in children if c is not child]
+        if nd in above:
+            cands.append(above[nd])
+        if cands:
+            d, leaf = min(cands, key=lambda x: x[0])
+            yield child, (d + _edge_len(child), leaf)
+
+def _nearest_leaves(tree):
+    '''Returns two dicts mapping each node to (path length, leaf) for the
+    closest leaf below it and for the closest leaf that is not below it.'''
+    below = {}
+    for nd in tree.postorder_node_iter():
+        below[nd] = (0.0, nd) if nd.is_leaf() else _closest_below(nd, below)
+    above = {}
+    for nd in tree.preorder_node_iter():
+        for child, closest in _closest_above_children(nd, below, above):
+            above[child] = closest
+    return below, above
+
+def _update_nearest_leaves(changed, below, above):
+    '''Updates the `below` and `above` dicts of `_nearest_leaves` after the
+    children or the edge lengths of the internal nodes in the list `changed`
+    (children before their parents, all below the parent of the last one)
+    were modified. Only the nodes whose closest leaves may have changed are
+    visited: the ancestors up to the first whose closest leaf below is the
+    same as before, and the descendants of that node whose closest leaf
+    above changed.
+    '''
+    touched = set(changed)
+    for nd in changed:
+        below[nd] = _closest_below(nd, below)
+    top = changed[-1]
+    nd = top.parent_node
+    while nd is not None:
+        top = nd
+        touched.add(nd)
+        closest = _closest_below(nd, below)
+        if closest == below[nd]:
+            break
+        below[nd] = closest
+        nd = nd.parent_node
+    stack = [top]
+    while stack:
+        nd = stack.pop()
+        for child, closest in _closest_above_children(nd, below, above):
+            if child in touched or above.get(child) != closest:
+                above[child] = closest
+                if not child.is_leaf():
+                    stack.append(child)
+
+# the number of levels of each subtree around an edge that are expanded in an NNI
+NNI_DEPTH = 6
+
+def _balanced_leaves(subtrees, depth, below, above):
+    '''Returns a list of (weight, leaf) for the subtrees given as (node, the
+    neighbor of node that is not in the subtree) pairs. The weight is split
+    evenly among the subtrees, and recursively among the subtrees hanging
+    off each node (as in the balanced minimum evolution criterion), down to
+    `depth` levels; below that a subtree is represented by its closest leaf.
+    '''
+    r = []
+    stack = [(nd, came_from, 1.0/len(subtrees), depth) for nd, came_from in subtrees]
+    while stack:
+        nd, came_from, weight, level = stack.pop()
+        toward_leaves = came_from is nd.parent_node
+        if toward_leaves and nd.is_leaf():
+            r.append((weight, nd))
+            continue
+        if level == 0:
+            r.append((weight, below[nd][1] if toward_leaves else above[came_from][1]))
+            continue
+        neighbors = [c for c in nd.child_nodes() if c is not came_from]
+        if nd.parent_node is not None and not toward_leaves:
+            neighbors.append(nd.parent_node)
+        for nb in neighbors:
+            stack.append((nb, nd, weight/len(neighbors), level - 1))
+    return r
+
+def _try_nni(nd, below, above, distance):
+    '''Tries the two nearest-neighbor interchanges around the internal edge
+    above `nd`, making the one that most reduces the four-point sum of the
+    balanced average distances between the four subtrees around the edge
+    (see `_balanced_leaves`), if any does. The `below` and `above` dicts of
+    `_nearest_leaves` are updated for the change. Returns True if the tree
+    was changed.
+    '''
+    parent = nd.parent_node
+    inner = nd.child_nodes()
+    if parent is None or len(inner) != 2:
+        return False
+    siblings = [c for c in parent.child_nodes() if c is not nd]
+    if parent.parent_node is None and len(siblings) == 1:
+        # the edge runs through a bifurcating root to the other side
+        x, y = siblings[0].child_nodes() if len(siblings[0].child_nodes()) == 2 else (None, None)
+        if x is None:
+            return False
+        rest = [(y, siblings[0])]
+    else:
+        x, y = siblings[0], None
+        rest = [(r, parent) for r in siblings[1:]]
+        if parent.parent_node is not None:
+            rest.append((parent.parent_node, parent))
+        if not rest:
+            return False
+    leaves = lambda subtrees: _balanced_leaves(subtrees, NNI_DEPTH, below, above)
+    a, b = leaves([(inner[0], nd)]), leaves([(inner[1], nd)])
+    c, d = leaves([(x, x.parent_node)]), leaves(rest)
+    dist = lambda first, second: sum(wf*ws*distance(f, s) for wf, f in first for ws, s in second)
+    current = dist(a, b) + dist(c, d)
+    swap_second = dist(a, c) + dist(b, d) # nd gets (inner[0], x)
+    swap_first = dist(b, c) + dist(a, d) # nd gets (inner[1], x)
+    tol = 1e-12*max(current, 1.0)
+    if min(swap_first, swap_second) >= current - tol:
+        return False
+    if swap_second <= swap_first:
+        moved, m, k = inner[1], b, a
+    else:
+        moved, m, k = inner[0], a, b
+    x_parent = x.parent_node
+    pos = x_parent.child_nodes().index(x)
+    x_parent.remove_child(x)
+    nd.remove_child(moved)
+    x_parent.insert_child(pos, moved)
+    nd.add_child(x)
+    # four-point estimate of the length of the edge for the new split {kept, x} | {moved, rest}
+    el = (dist(k, m) + dist(k, d) + dist(c, m) + dist(c, d))/4.0 - (dist(k, c) + dist(m, d))/2.0
+    if y is None:
+        nd.edge.length = max(el, 0.0)
+    else:
+        # the edge is split by the root
+        nd.edge.length = siblings[0].edge.length = max(el, 0.0)/2.0
+    _update_nearest_leaves([nd] if x_parent is parent else [nd, x_parent], below, above)
+    return True
+
+def _local_rearrangement(tree, leaf, search_radius, distance):
+    '''Makes nearest-neighbor interchanges (see `_try_nni`) on the internal
+    edges within `search_radius` edges of `leaf` until none improves. The
+    closest leaves of the nodes are found once, and each swap updates only
+    the nodes near it (see `_update_nearest_leaves`).'''
+    max_swaps = 4*len(_nodes_within(leaf, search_radius))
+    below, above = _nearest_leaves(tree)
+    for swap in range(max_swaps):
+        for nd in _nodes_within(leaf, search_radius):
+            if not nd.is_leaf() and _try_nni(nd, below, above, distance):
+                break
+        else:
+            return
+
+def extend_nj_tree(tree, dist_mat, search_radius=4, max_residual=None):
+    '''Adds the taxa of the distance matrix `dist_mat` (a dict of dicts, as
+    returned by `parse_distances`) that are not yet leaves of `tree` (whose
+    leaf labels are the str of the matrix keys), rather than rebuilding
+    the NJ tree.
+
+    Each new taxon is placed on the edge where a weighted least-squares fit
+    of its distances to all of the leaves is best (all of the edges are fit
+    in one pass over the tree); the edge is split and the pendant edge
+    length is set from the fit. Then nearest-neighbor interchanges are
+    tried on the edges within `search_radius` edges of the new leaf (see
+    `_try_nni`). So the cost of each insertion grows linearly with the
+    number of leaves, not cubically as for a new NJ tree.
+
+    If `max_residual` is given and the relative error of a placement (the
+    root-mean-square of (fitted - observed distance)/observed distance)
+    exceeds it, the whole tree is rebuilt with `nj_tree_from_distances`.
+
+    Returns (tree, was_rebuilt).
+    '''
+    label2key = dict((str(k), k) for k in dist_mat.keys())
+    leaf_keys = {}
+    for leaf in tree.leaf_node_iter():
+        label = leaf.taxon.label if leaf.taxon is not None else None
+        if label not in label2key:
+            raise ValueError('The tree leaf "{}" is not in the distance matrix.\n'.format(label))
+        leaf_keys[leaf] = label2key[label]
+    distance = lambda first, second: dist_mat[leaf_keys[first]][leaf_keys[second]]
+    placed = set(leaf_keys.values())
+    new_keys = [k for k in sorted(dist_mat.keys()) if k not in placed]
+    for key in new_keys:
+        row = dist_mat[key]
+        dist_to_new = dict((leaf, row[lk]) for leaf, lk in leaf_keys.items())
+        sse, nd, t, b = _best_placement(tree, dist_to_new)
+        if max_residual is not None:
+            sum_sq = sum(_weight(d)*d*d for d in dist_to_new.values())
+            if sum_sq > 0.0 and (sse/sum_sq)**0.5 > max_residual:
+                return nj_tree_from_distances(dist_mat), True
+        # split the edge above nd: parent -- (el - t) -- new_internal -- t -- nd
+        el = _edge_len(nd)
+        parent = nd.parent_node
+        pos = parent.child_nodes().index(nd)
+        parent.remove_child(nd)
+        new_internal = dendropy.Node(edge_length=el - t)
+        parent.insert_child(pos, new_internal)
+        new_internal.add_child(nd)
+        nd.edge.length = t
+        taxon = tree.taxon_namespace.require_taxon(label=str(key))
+        leaf = new_internal.new_child(taxon=taxon, edge_length=b)
+        leaf_keys[leaf] = key
+        if search_radius > 0:
+            _local_rearrangement(tree, leaf, search_radius, distance)
+    return tree, False
 
 def convert_to_dendropy_dist(dist_mat):
     '''Takes a distance matrix as a dict of dicts.
@@ -51,11 +419,20 @@ if __name__ == '__main__':
     import sys
     import os
     script_name = os.path.split(sys.argv[0])[1]
-    description = '''Takes a filepath to a quirky space-separated representation of the distance matrix. Prints an NJ tree.'''
+    description = '''Takes a filepath to a quirky space-separated representation of the distance matrix. Prints an NJ tree.
+With --tree, the taxa that are not in the existing tree are added to it one at a time (rather than rebuilding the tree).'''
     parser = argparse.ArgumentParser(prog=script_name, description=description)
+    parser.add_argument('--tree', default=None, type=str, required=False, help='filepath of an existing (newick) NJ tree. Only the taxa of the distance matrix that are not in it are added')
+    parser.add_argument('--search-radius', default=4, type=int, required=False, help='with --tree, nearest-neighbor interchanges are tried on the edges within this many edges of each new taxon (0 for none). Default is 4')
+    parser.add_argument('--max-residual', default=None, type=float, required=False, help='with --tree, rebuild the NJ tree from scratch if the relative least-squares error of a placement exceeds this')
+    parser.add_argument('--output', default=None, type=str, required=False, help='filepath for the tree (newick). Default is to print a plot of the tree')
     parser.add_argument('distances')
     args = parser.parse_args(sys.argv[1:])
     try:
-        _main(args.distances)
+        _main(args.distances,
+              tree_filepath=args.tree,
+              output_filepath=args.output,
+              search_radius=args.search_radius,
+              max_residual=args.max_residual)
     except Exception as x:
         sys.exit('{}: {}\n'.format(script_name, str(x)))
@@ -38,8 +38,17 @@ then
     model and original tree correspond to a model that yields 
     consistent estimates).
 '''
+import os
 from dendropy.datamodel.charmatrixmodel import data_type_matrix_map, \
                                                DnaCharacterMatrix
+try:
+    xrange
+except NameError:
+    xrange = range # python 3
+try:
+    from dendrobites.compressed_io import read_from_path, write_to_path
+except ImportError:
+    from compressed_io import read_from_path, write_to_path
 
 
 def induced_matrix_and_tree(char_mat_filepath,
@@ -154,6 +163,8 @@ def calc_num_to_cull_by_state(num_inv_columns, symbol2ind_set):
                 symbols).
     '''
     num_const_gapless = sum([len(v) for v in symbol2ind_set.values()])
+    if num_const_gapless == 0:
+        return {}
     invariant_frac = num_inv_columns/float(num_const_gapless)
     ideal_num_to_cull = int(round(num_inv_columns))
     num_to_cull_by_state = {}
@@ -166,14 +177,13 @@ def calc_num_to_cull_by_state(num_inv_columns, symbol2ind_set):
         num_to_cull_by_state[state] = (num_to_cull_for_this_state, len(col_ind_for_this_state))
     # Deal with rounding error
     if num_left_to_cull > 0:
-        sym_list = num_to_cull_by_state.keys()
-        sym_list.sort()
+        sym_list = sorted(num_to_cull_by_state.keys())
         for state in sym_list:
             tc, tot = num_to_cull_by_state[state]
             ntc = min(tc + num_left_to_cull, tot)
             if ntc != tc:
                 num_added = ntc - tc
-                num_to_cull_by_state[state] = (ntc, tc)
+                num_to_cull_by_state[state] = (ntc, tot)
                 num_left_to_cull -= num_added
                 if num_left_to_cull == 0:
                     break
@@ -204,27 +214,150 @@ def new_mat_by_del_paired_invariants(char_mat, p_inv):
     Returns a proxy for the a matrix representing the results of the free-to-vary evolution
     by removing constant, gapless columns from char_mat.
     '''
+    return new_mat_and_summary_by_del_paired_invariants(char_mat, p_inv)[0]
+
+def new_mat_and_summary_by_del_paired_invariants(char_mat, p_inv):
+    '''Like `new_mat_by_del_paired_invariants`, but returns (retained, summary)
+    where summary is a dict with the keys:
+        "num_columns", "num_gap_cells", "est_equil_len", and
+        "num_to_cull_by_state" (the output of `calc_num_to_cull_by_state`).
+    '''
     r = characterize_mat_wrt_const_gapless(char_mat)
     num_cols, num_gap_cells, const_col_type2ind_set = r
     num_taxa = len(char_mat)
     est_equil_len = (num_cols*len(char_mat) - num_gap_cells)/float(num_taxa)
     est_num_inv_columns = p_inv*est_equil_len
-    to_cull = calc_inds_to_cull(num_inv_columns=est_num_inv_columns,
-                                const_col_type2ind_set=const_col_type2ind_set)
+    num_to_cull_by_state = calc_num_to_cull_by_state(num_inv_columns=est_num_inv_columns,
+                                                     symbol2ind_set=const_col_type2ind_set)
+    to_cull = create_inds_to_cull_from_numbers_to_cull(symbol2ind_set=const_col_type2ind_set,
+                                                       num_to_cull_by_state=num_to_cull_by_state)
     to_retain = set(xrange(num_cols))
     to_retain.difference_update(to_cull)
     label = 'to_retain'
     char_mat.new_character_subset(label=label, character_indices=to_retain)
     retained = char_mat.export_character_subset(character_subset=label)
     # need to remove the char subset because they are not being re-indexed.
-    del retained.character_subsets[label]
-    return retained
+    # (newer versions of dendropy do not copy it to the exported matrix)
+    if label in retained.character_subsets:
+        del retained.character_subsets[label]
+    # leave the input matrix as it was
+    del char_mat.character_subsets[label]
+    summary = {'num_columns': num_cols,
+               'num_gap_cells': num_gap_cells,
+               'est_equil_len': est_equil_len,
+               'num_to_cull_by_state': num_to_cull_by_state}
+    return retained, summary
+
+SUMMARY_COLUMNS = ['locus',
+                   'p_inv',
+                   'num_columns',
+                   'num_gap_cells',
+                   'est_equil_len',
+                   'num_const_gapless',
+                   'num_culled',
+                   'culled_by_state']
+
+def summary_row(locus, p_inv, summary):
+    '''Returns the fields of a summary table row (see SUMMARY_COLUMNS) as strings.
+    The "culled_by_state" field lists state=culled/constant-gapless columns.
+    '''
+    by_state = summary['num_to_cull_by_state']
+    states = sorted(by_state.keys())
+    return [locus,
+            str(p_inv),
+            str(summary['num_columns']),
+            str(summary['num_gap_cells']),
+            '{:.3f}'.format(summary['est_equil_len']),
+            str(sum(by_state[i][1] for i in states)),
+            str(sum(by_state[i][0] for i in states)),
+            ';'.join('{}={}/{}'.format(i, by_state[i][0], by_state[i][1]) for i in states)]
+
+def read_locus_list(path, default_p_inv=None):
+    '''Returns a list of (filepath, p_inv) for the loci in `path`.
+
+    If `path` is a directory, every (non-hidden) file in it is a locus.
+    Otherwise `path` is a manifest with one filepath per line (relative to
+    the manifest's directory), optionally followed by a tab and the p_inv
+    for that locus. Blank lines and lines starting with # are ignored.
+    Loci without a p_inv use `default_p_inv`.
+    '''
+    loci = []
+    if os.path.isdir(path):
+        for fn in sorted(os.listdir(path)):
+            fp = os.path.join(path, fn)
+            if not fn.startswith('.') and os.path.isfile(fp):
+                loci.append((fp, default_p_inv))
+    else:
+        directory = os.path.dirname(os.path.abspath(path))
+        with open(path, 'r') as inp:
+            for line in inp:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                fields = line.split('\t')
+                p_inv = float(fields[1]) if len(fields) > 1 and fields[1].strip() else default_p_inv
+                loci.append((os.path.join(directory, fields[0].strip()), p_inv))
+    for fp, p_inv in loci:
+        if p_inv is None:
+            raise ValueError('No p_inv was given for "{}".\n'.format(fp))
+        if not (0.0 < p_inv < 1.0):
+            raise ValueError('The p_inv for "{}" must be between 0 and 1.\n'.format(fp))
+    return loci
+
+def _cull_locus(job):
+    '''Worker for `multi_locus_paired_invariants_cull`.'''
+    char_mat_filepath, p_inv, output_filepath, mat_type, schema, num_threads = job
+    char_mat = read_from_path(mat_type, char_mat_filepath, schema=schema, num_threads=num_threads)
+    retained, summary = new_mat_and_summary_by_del_paired_invariants(char_mat, p_inv)
+    write_to_path(retained, output_filepath, schema=schema, num_threads=num_threads)
+    return summary_row(os.path.basename(char_mat_filepath), p_inv, summary)
+
+def multi_locus_paired_invariants_cull(loci,
+                                       output_dir,
+                                       summary_stream,
+                                       char_type=DnaCharacterMatrix,
+                                       schema='nexus',
+                                       num_workers=None):
+    '''Culls each (filepath, p_inv) locus in `loci` in a pool of
+    `num_workers` processes (default: one per CPU), writing the culled
+    matrix to a file of the same name in `output_dir`, and writes a
+    tab-separated summary table (see SUMMARY_COLUMNS) to `summary_stream`
+    as the loci finish (in the order of `loci`). Compressed loci are
+    (de)compressed on an equal share of the CPUs in each process.
+    '''
+    import multiprocessing
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+    num_threads = max(multiprocessing.cpu_count()//num_workers, 1)
+    jobs = []
+    out_names = set()
+    for fp, p_inv in loci:
+        name = os.path.basename(fp)
+        if name in out_names:
+            raise ValueError('More than one locus would be written to "{}" in the output directory.\n'.format(name))
+        out_names.add(name)
+        ofp = os.path.join(output_dir, name)
+        if os.path.exists(ofp):
+            raise RuntimeError('"{}" already exists! Move it before running this script.\n'.format(ofp))
+        jobs.append((fp, p_inv, ofp, char_type, schema, num_threads))
+    summary_stream.write('\t'.join(SUMMARY_COLUMNS) + '\n')
+    pool = multiprocessing.Pool(num_workers)
+    try:
+        for row in pool.imap(_cull_locus, jobs):
+            summary_stream.write('\t'.join(row) + '\n')
+    finally:
+        pool.close()
+        pool.join()
 
 
 def _main(char_mat_filepath,
           data_type_name,
           p_inv,
-          schema='nexus'):
+          schema='nexus',
+          output_filepath=None,
+          output_dir=None,
+          summary_filepath=None,
+          num_workers=None):
     # Validate the data_type argument and use it to find the CharacterMatrix type
     dt = data_type_name.lower()
     mat_type = data_type_matrix_map.get(dt)
@@ -233,28 +366,60 @@ def _main(char_mat_filepath,
         k = data_type_matrix_map.keys()
         k.sort()
         raise ValueError(emf.format(u=data_type_name, t='", "'.join(k)))
+    if output_dir:
+        loci = read_locus_list(char_mat_filepath, default_p_inv=p_inv)
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        if summary_filepath:
+            with open(summary_filepath, 'w') as summary_stream:
+                multi_locus_paired_invariants_cull(loci, output_dir, summary_stream,
+                                                   char_type=mat_type, schema=schema,
+                                                   num_workers=num_workers)
+        else:
+            multi_locus_paired_invariants_cull(loci, output_dir, sys.stdout,
+                                               char_type=mat_type, schema=schema,
+                                               num_workers=num_workers)
+        return
     # read the char matrix 
-    char_mat = mat_type.get(path=char_mat_filepath, schema=schema)
+    char_mat = read_from_path(mat_type, char_mat_filepath, schema=schema)
     retained = new_mat_by_del_paired_invariants(char_mat, p_inv)
-    retained.write_to_stream(sys.stdout, schema=schema)
+    if output_filepath:
+        write_to_path(retained, output_filepath, schema=schema)
+    else:
+        retained.write_to_stream(sys.stdout, schema=schema)
 
 if __name__ == '__main__':
     import argparse
     import sys
     import os
     script_name = os.path.split(sys.argv[0])[1]
-    description = '''Subsample constant, gapless columns as if they were generated under the paired-invariants model.'''
+    description = '''Subsample constant, gapless columns as if they were generated under the paired-invariants model.
+With --out-dir, datafile is a directory of alignments or a manifest listing one alignment (and, optionally, a tab and its p_inv) per line.
+Each culled alignment is written to --out-dir and a summary table is written to standard output (or --summary).'''
     parser = argparse.ArgumentParser(prog=script_name, description=description)
     parser.add_argument('--data-type', default='dna', type=str, required=False, help='a data_type. Default is "dna"')
     parser.add_argument('--schema', default='nexus', type=str, required=False, help='A file format name. Default is "nexus"')
     parser.add_argument('datafile', default=None, nargs=1, help='filepath of the character data')
-    parser.add_argument('--p-inv', required=True, type=float, help='A proportion of invariant sites for the paired-invariants model')
+    parser.add_argument('--p-inv', required=False, type=float, help='A proportion of invariant sites for the paired-invariants model (with --out-dir, the default for loci with no p_inv in the manifest)')
+    parser.add_argument('--output', default=None, type=str, required=False, help='filepath for the culled matrix (compressed if it ends in .gz, .bz2, .xz or .zst). Default is standard output')
+    parser.add_argument('--out-dir', default=None, type=str, required=False, help='process many alignments; the directory for the culled alignments')
+    parser.add_argument('--summary', default=None, type=str, required=False, help='with --out-dir, filepath for the summary table. Default is standard output')
+    parser.add_argument('--num-workers', default=None, type=int, required=False, help='with --out-dir, the number of worker processes. Default is the number of CPUs')
     args = parser.parse_args(sys.argv[1:])
     try:
-        assert args.p_inv > 0.0
-        assert args.p_inv < 1.0
+        if args.out_dir is None or args.p_inv is not None:
+            assert args.p_inv is not None
+            assert args.p_inv > 0.0
+            assert args.p_inv < 1.0
         assert len(args.datafile) == 1
-        _main(args.datafile[0], args.data_type, schema=args.schema, p_inv=args.p_inv)
+        _main(args.datafile[0],
+              args.data_type,
+              schema=args.schema,
+              p_inv=args.p_inv,
+              output_filepath=args.output,
+              output_dir=args.out_dir,
+              summary_filepath=args.summary,
+              num_workers=args.num_workers)
     except Exception as x:
         raise
         sys.exit('{}: {}\n'.format(script_name, str(x)))
@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+'''Runs several DendroBites steps as one pipeline, passing the matrices
+and trees from step to step in memory rather than through files.
+
+The pipeline is described by a JSON file holding a list of stages
+(or an object with a "stages" list). Each stage is an object with a
+unique "name", a "type" and, for every type other than "read", the
+"input" name of an earlier stage whose (char_mat, tree) it works on.
+
+Stage types and their settings:
+    read -- "char" and/or "tree" filepaths, "data_type" (default "dna"),
+        "char_schema" (default "fasta"), "tree_schema" (default "newick")
+    prune -- "taxa": the labels to retain (see `induced_matrix_and_tree`),
+        "single_pass" (default false)
+    paired_invariants_cull -- "p_inv" (see `paired_invariants_cull`)
+    find_synapo -- "taxa": the ingroup labels (see `find_synapo_signal`)
+    nj -- a neighbor-joining tree from the uncorrected p-distances of
+        the input matrix (see `neighbor_joining`)
+
+Any stage may be written to disk by giving "char_out" and/or "tree_out"
+filepaths ("out" for the columns found by a find_synapo stage). The
+schemas used for writing are the stage's "char_schema" and "tree_schema"
+settings (defaults "fasta" and "newick"). Outputs are compressed if the
+filepath ends in .gz, .bz2, .xz or .zst.
+
+Each stage is started in a pool of worker processes as soon as the stage
+that it reads from has finished, so independent branches of the pipeline
+run on different CPUs and a slow stage only holds up the stages
+downstream of it. dendropy matrices and trees cannot be pickled, so a
+stage's result is handed to the stages that read it (through a pipe, not
+a file) as its taxon labels, the symbols of the rows of its matrix and
+the newick string of its tree, from which each of those stages builds
+its own copy.
+
+Example:
+    [{"name": "data", "type": "read", "char": "a.fas", "tree": "a.tre"},
+     {"name": "ab", "type": "prune", "input": "data", "taxa": ["A", "B", "C"],
+      "tree_out": "pruned.tre"},
+     {"name": "culled", "type": "paired_invariants_cull", "input": "ab",
+      "p_inv": 0.3, "char_out": "culled.fas.gz"},
+     {"name": "syn", "type": "find_synapo", "input": "culled", "taxa": ["A"],
+      "out": "synapo.txt"},
+     {"name": "nj", "type": "nj", "input": "culled", "tree_out": "nj.tre"}]
+'''
+import multiprocessing
+import pickle
+try:
+    import queue
+except ImportError:
+    import Queue as queue # python 2
+import dendropy
+from dendropy.datamodel.charmatrixmodel import data_type_matrix_map, \
+                                               ContinuousCharacterMatrix
+try:
+    from dendrobites.compressed_io import read_from_path, write_to_path, open_output
+    from dendrobites.induced_matrix_and_tree import read_matrix_and_tree, prune_matrix_and_tree
+    from dendrobites.paired_invariants_cull import new_mat_by_del_paired_invariants
+    from dendrobites.find_synapo_signal import find_ingroup_taxa, \
+                                              find_potential_synapo_columns, \
+                                              write_potential_synapo_columns
+    from dendrobites.neighbor_joining import nj_tree_from_distances, p_distances
+except ImportError:
+    from compressed_io import read_from_path, write_to_path, open_output
+    from induced_matrix_and_tree import read_matrix_and_tree, prune_matrix_and_tree
+    from paired_invariants_cull import new_mat_by_del_paired_invariants
+    from find_synapo_signal import find_ingroup_taxa, \
+                                   find_potential_synapo_columns, \
+                                   write_potential_synapo_columns
+    from neighbor_joining import nj_tree_from_distances, p_distances
+
+def _run_read(stage, upstream):
+    dt = stage.get('data_type', 'dna').lower()
+    mat_type = data_type_matrix_map.get(dt)
+    if mat_type is None:
+        raise ValueError('Stage "{}": the data type "{}" is not recognized.\n'.format(stage['name'], dt))
+    char_schema = stage.get('char_schema', 'fasta')
+    if stage.get('tree'):
+        return read_matrix_and_tree(stage.get('char'),
+                                    stage['tree'],
+                                    char_type=mat_type,
+                                    char_schema=char_schema,
+                                    tree_schema=stage.get('tree_schema', 'newick'))
+    if not stage.get('char'):
+        raise ValueError('Stage "{}": a "read" stage needs a "char" or "tree" filepath.\n'.format(stage['name']))
+    return read_from_path(mat_type, stage['char'], schema=char_schema), None
+
+def _run_prune(stage, upstream):
+    char_mat, tree = upstream
+    return prune_matrix_and_tree(char_mat,
+                                 tree,
+                                 stage['taxa'],
+                                 single_pass=stage.get('single_pass', False))
+
+def _run_paired_invariants_cull(stage, upstream):
+    char_mat, tree = upstream
+    return new_mat_by_del_paired_invariants(char_mat, stage['p_inv']), tree
+
+def _run_find_synapo(stage, upstream):
+    char_mat = upstream[0]
+    ingroup_taxa = find_ingroup_taxa(char_mat, stage['taxa'])
+    return find_potential_synapo_columns(char_mat, ingroup_taxa)
+
+def _run_nj(stage, upstream):
+    char_mat = upstream[0]
+    return None, nj_tree_from_distances(p_distances(char_mat))
+
+# stage type -> (function, whether it modifies its input, whether it produces a (char_mat, tree) pair)
+STAGE_TYPES = {'read': (_run_read, False, True),
+               'prune': (_run_prune, True, True),
+               'paired_invariants_cull': (_run_paired_invariants_cull, True, True),
+               'find_synapo': (_run_find_synapo, False, False),
+               'nj': (_run_nj, False, True),
+              }
+
+def validate_stages(stages):
+    '''Checks that the stage names are unique, the types are known and
+    that each stage's input is an earlier stage that produces a matrix
+    and tree. Returns a dict of stage name -> list of consuming stage names.
+    '''
+    consumers = {}
+    produces_data = {}
+    for stage in stages:
+        name = stage.get('name')
+        if name is None:
+            raise ValueError('Every stage needs a "name".\n')
+        if name in consumers:
+            raise ValueError('The stage name "{}" is repeated.\n'.format(name))
+        st = stage.get('type')
+        if st not in STAGE_TYPES:
+            k = sorted(STAGE_TYPES.keys())
+            raise ValueError('Stage "{}": the type "{}" is not recognized.\nExpecting one of "{}".\n'.format(name, st, '", "'.join(k)))
+        inp = stage.get('input')
+        if st == 'read':
+            if inp is not None:
+                raise ValueError('Stage "{}": a "read" stage does not take an "input".\n'.format(name))
+        else:
+            if inp not in consumers:
+                raise ValueError('Stage "{}": the input "{}" is not the name of an earlier stage.\n'.format(name, inp))
+            if not produces_data[inp]:
+                raise ValueError('Stage "{}": the input "{}" does not produce a matrix or tree.\n'.format(name, inp))
+            consumers[inp].append(name)
+        consumers[name] = []
+        produces_data[name] = STAGE_TYPES[st][2]
+    return consumers
+
+def _write_outputs(stage, result):
+    if stage['type'] == 'find_synapo':
+        if stage.get('out'):
+            with open_output(stage['out']) as outp:
+                write_potential_synapo_columns(result, outp)
+        return
+    char_mat, tree = result
+    if stage.get('char_out'):
+        if char_mat is None:
+            raise ValueError('Stage "{}" has no character matrix to write.\n'.format(stage['name']))
+        write_to_path(char_mat, stage['char_out'], schema=stage.get('char_schema', 'fasta'))
+    if stage.get('tree_out'):
+        if tree is None:
+            raise ValueError('Stage "{}" has no tree to write.\n'.format(stage['name']))
+        write_to_path(tree, stage['tree_out'], schema=stage.get('tree_schema', 'newick'))
+
+def _pack(result):
+    '''Returns the (char_mat, tree) `result` of a stage as picklable
+    (taxon labels, (matrix type, rows), newick) for `_unpack`.'''
+    char_mat, tree = result
+    tns = tree.taxon_namespace if char_mat is None else char_mat.taxon_namespace
+    labels = [taxon.label for taxon in tns]
+    packed_mat = None
+    if char_mat is not None:
+        index = dict((taxon, i) for i, taxon in enumerate(tns))
+        if isinstance(char_mat, ContinuousCharacterMatrix):
+            rows = [(index[taxon], list(char_mat[taxon].values())) for taxon in char_mat]
+        else:
+            rows = [(index[taxon], char_mat[taxon].symbols_as_string()) for taxon in char_mat]
+        packed_mat = (type(char_mat), rows)
+    newick = None if tree is None else tree.as_string(schema='newick')
+    return labels, packed_mat, newick
+
+def _unpack(packed):
+    '''Returns the (char_mat, tree) packed by `_pack`, sharing a new taxon namespace.'''
+    labels, packed_mat, newick = packed
+    tns = dendropy.TaxonNamespace()
+    taxa = []
+    for label in labels:
+        taxon = dendropy.Taxon(label)
+        tns.add_taxon(taxon)
+        taxa.append(taxon)
+    char_mat = None
+    if packed_mat is not None:
+        mat_type, rows = packed_mat
+        char_mat = mat_type(taxon_namespace=tns)
+        for i, row in rows:
+            if not isinstance(char_mat, ContinuousCharacterMatrix):
+                row = char_mat.default_state_alphabet.get_states_for_symbols(row)
+            char_mat.new_sequence(taxa[i], row)
+    tree = None
+    if newick is not None:
+        tree = dendropy.Tree.get(data=newick, schema='newick', taxon_namespace=tns)
+    return char_mat, tree
+
+def _run_stage(job):
+    '''Worker for `run_pipeline`: runs the stage on the packed (see `_pack`)
+    result of its input stage. Returns (name, result, None), with the
+    result packed if `pack` is True, or (name, None, exception) if the
+    stage failed.'''
+    stage, packed_upstream, pack = job
+    try:
+        upstream = None if packed_upstream is None else _unpack(packed_upstream)
+        result = STAGE_TYPES[stage['type']][0](stage, upstream)
+        _write_outputs(stage, result)
+        if pack and STAGE_TYPES[stage['type']][2]:
+            result = _pack(result)
+        elif not pack:
+            result = None
+    except Exception as x:
+        try:
+            pickle.dumps(x)
+        except Exception:
+            x = RuntimeError(str(x))
+        return stage['name'], None, x
+    return stage['name'], result, None
+
+def run_pipeline(stages, num_workers=None, keep_final=True):
+    '''Runs the list of `stages` (dicts, as described in the module docstring).
+    Each stage is run in a pool of `num_workers` processes (default: one
+    per CPU) as soon as its input is ready. A stage's result is released
+    once every stage that reads it has been started.
+    Returns a dict mapping the name of each final stage (those that are
+    not the input of another stage) to its result, or to None if
+    `keep_final` is False (which saves sending the results back from the
+    worker processes).
+    '''
+    consumers = validate_stages(stages)
+    by_name = dict((stage['name'], stage) for stage in stages)
+    finished = queue.Queue()
+    final = {}
+    pool = multiprocessing.Pool(num_workers)
+    try:
+        num_running = 0
+        for stage in stages:
+            if stage.get('input') is None:
+                pack = keep_final or bool(consumers[stage['name']])
+                pool.apply_async(_run_stage, ((stage, None, pack),), callback=finished.put)
+                num_running += 1
+        while num_running:
+            name, result, error = finished.get()
+            num_running -= 1
+            if error is not None:
+                raise error
+            if not consumers[name]:
+                final[name] = result
+                if result is not None and STAGE_TYPES[by_name[name]['type']][2]:
+                    final[name] = _unpack(result)
+            for consumer_name in consumers[name]:
+                pack = keep_final or bool(consumers[consumer_name])
+                job = (by_name[consumer_name], result, pack)
+                pool.apply_async(_run_stage, (job,), callback=finished.put)
+                num_running += 1
+    finally:
+        pool.terminate()
+        pool.join()
+    return final
+
+def _main(stages_filepath, num_workers=None):
+    import json
+    with open(stages_filepath, 'r') as inp:
+        stages = json.load(inp)
+    if isinstance(stages, dict):
+        stages = stages.get('stages')
+    if not isinstance(stages, list) or not stages:
+        raise ValueError('Expecting a list of stages in "{}".\n'.format(stages_filepath))
+    run_pipeline(stages, num_workers=num_workers, keep_final=False)
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+    import os
+    script_name = os.path.split(sys.argv[0])[1]
+    description = '''Runs the stages of the pipeline described in a JSON file, passing the data between stages in memory.'''
+    parser = argparse.ArgumentParser(prog=script_name, description=description)
+    parser.add_argument('--num-workers', default=None, type=int, required=False, help='the number of worker processes (stages run at once). Default is the number of CPUs')
+    parser.add_argument('stages', help='filepath of the JSON description of the stages')
+    args = parser.parse_args(sys.argv[1:])
+    try:
+        _main(args.stages, num_workers=args.num_workers)
+    except Exception as x:
+        sys.exit('{}: {}\n'.format(script_name, str(x)))
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+'''Proposes matches between two sets of taxon labels that differ by
+typos, case, or the use of underscores/spaces/hyphens (e.g. the leaf
+labels of a tree and the row labels of a matrix).
+
+Labels are first compared in a normalized form (lower case, with runs
+of "_", "-" and whitespace collapsed to one space). Labels that still
+differ are looked up in an index of the character trigrams of the
+candidate labels, and only the few candidates that share the most
+trigrams are compared by edit distance. So the cost grows roughly
+linearly with the number of labels, rather than with the number of
+pairs of labels.
+
+The accepted matches can be saved as a "rename map": a tab-separated
+file with an old label and its new label on each line (lines starting
+with # are ignored). `apply_rename_map` relabels the taxa of a taxon
+namespace with such a map.
+'''
+import heapq
+import re
+
+_SEPARATORS = re.compile(r'[\s_\-]+')
+
+def normalize_label(label):
+    '''Lower case `label` and collapse runs of "_", "-" and whitespace to a single space.'''
+    return _SEPARATORS.sub(' ', label).strip().lower()
+
+def _trigrams(norm):
+    padded = '  ' + norm + ' '
+    return set(padded[i:i + 3] for i in range(len(padded) - 2))
+
+def edit_distance(first, second):
+    '''Returns the Levenshtein distance between two strings.'''
+    if len(first) < len(second):
+        first, second = second, first
+    prev = list(range(len(second) + 1))
+    for i, a in enumerate(first):
+        curr = [i + 1]
+        for j, b in enumerate(second):
+            curr.append(min(prev[j + 1] + 1, curr[j] + 1, prev[j] + (a != b)))
+        prev = curr
+    return prev[-1]
+
+def similarity(first, second):
+    '''Returns 1 - (edit distance of the normalized labels)/(length of the longer one).'''
+    f, s = normalize_label(first), normalize_label(second)
+    longest = max(len(f), len(s))
+    if longest == 0:
+        return 1.0
+    return 1.0 - edit_distance(f, s)/float(longest)
+
+class LabelIndex(object):
+    '''An index of candidate labels by normalized form and by trigram.'''
+    def __init__(self, labels, max_scanned=1000):
+        '''Each lookup scans the candidates of the rarest trigrams of the
+        label first, and stops adding trigrams once `max_scanned` index
+        entries have been scanned (common trigrams say little about which
+        candidate is the best match).
+        '''
+        self.labels = list(labels)
+        self.max_scanned = max_scanned
+        self._by_norm = {}
+        self._grams = []
+        self._postings = {}
+        for ind, label in enumerate(self.labels):
+            norm = normalize_label(label)
+            self._by_norm.setdefault(norm, []).append(ind)
+            grams = _trigrams(norm)
+            self._grams.append(len(grams))
+            for g in grams:
+                self._postings.setdefault(g, []).append(ind)
+
+    def best_match(self, label, num_to_check=5):
+        '''Returns (candidate label, similarity) for the candidate that is
+        most similar to `label`, or (None, 0.0) if there are no candidates.
+        '''
+        norm = normalize_label(label)
+        exact = self._by_norm.get(norm)
+        if exact:
+            return self.labels[exact[0]], 1.0
+        grams = _trigrams(norm)
+        postings = sorted((self._postings[g] for g in grams if g in self._postings), key=len)
+        if not postings:
+            return None, 0.0
+        shared = {}
+        num_scanned = 0
+        for p in postings:
+            if num_scanned and num_scanned + len(p) > self.max_scanned:
+                break
+            num_scanned += len(p)
+            for ind in p:
+                shared[ind] = shared.get(ind, 0) + 1
+        # Dice coefficient of the trigram sets
+        num_grams, cand_grams = len(grams), self._grams
+        dice = lambda item: item[1]/float(num_grams + cand_grams[item[0]])
+        top = [ind for ind, count in heapq.nlargest(num_to_check, shared.items(), key=dice)]
+        best, best_score = None, 0.0
+        for ind in top:
+            score = similarity(label, self.labels[ind])
+            if score > best_score:
+                best, best_score = self.labels[ind], score
+        return best, best_score
+
+def reconcile_labels(unmatched, candidates, min_score=0.5):
+    '''Proposes a match among `candidates` for each label in `unmatched`.
+    Each candidate is given to at most one label (the most similar one).
+    Returns a list of (label, candidate or None, score) in the order of
+    `unmatched`; candidate is None if no unused candidate has a
+    similarity of at least `min_score`.
+    '''
+    index = LabelIndex(candidates)
+    proposals = [(label,) + index.best_match(label) for label in unmatched]
+    order = sorted(range(len(proposals)), key=lambda i: proposals[i][2], reverse=True)
+    used = set()
+    r = [None]*len(proposals)
+    for i in order:
+        label, cand, score = proposals[i]
+        if cand is None or score < min_score or cand in used:
+            r[i] = (label, None, score)
+        else:
+            used.add(cand)
+            r[i] = (label, cand, score)
+    return r
+
+def write_rename_map(pairs, dest):
+    '''Writes (old label, new label) pairs to the stream `dest` as tab-separated lines.'''
+    for old, new in pairs:
+        dest.write('{}\t{}\n'.format(old, new))
+
+def read_rename_map(path):
+    '''Reads a rename map file into a dict of old label -> new label.'''
+    rename = {}
+    with open(path, 'r') as inp:
+        for line in inp:
+            line = line.rstrip('\r\n')
+            if not line or line.startswith('#'):
+                continue
+            old, new = line.split('\t')
+            rename[old] = new
+    return rename
+
+def check_renamed_labels(labels, rename_map):
+    '''Raises a ValueError if relabeling `labels` by `rename_map` would give
+    two of them the same label.'''
+    seen = set()
+    for label in labels:
+        new = rename_map.get(label, label)
+        if new in seen:
+            raise ValueError('Applying the rename map would give more than one taxon the label "{}".\n'.format(new))
+        seen.add(new)
+
+def apply_rename_map(taxon_namespace, rename_map):
+    '''Relabels the taxa of `taxon_namespace` whose labels are keys of `rename_map`.
+    Raises a ValueError (and leaves the taxa unchanged) if that would give
+    two taxa the same label.'''
+    check_renamed_labels([taxon.label for taxon in taxon_namespace], rename_map)
+    for taxon in taxon_namespace:
+        new = rename_map.get(taxon.label)
+        if new is not None:
+            taxon.label = new
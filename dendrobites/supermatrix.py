@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+'''Builds a supermatrix by reducing many per-gene alignments to a shared
+set of taxa and concatenating them.
+
+Each gene is read and reduced (in a pool of worker processes) to the
+sequences of the retained taxa, which are looked up by label. The reduced
+genes are written, in the order given, as the blocks of an interleaved
+NEXUS or PHYLIP matrix as soon as each one is ready, so only a few genes
+are in memory at any time: no more than two genes per worker are read
+ahead of the one being written. Taxa that are absent from a gene are given
+missing data ("?") for that gene.
+
+A partition file lists the columns of each gene in the supermatrix, as a
+NEXUS "sets" block of charsets or as a RAxML-style partition file.
+'''
+import os
+import re
+import shutil
+import tempfile
+from collections import deque
+from dendropy.datamodel.charmatrixmodel import data_type_matrix_map, \
+                                               DnaCharacterMatrix
+try:
+    from dendrobites.compressed_io import read_from_path, open_output, EXTENSION_TO_CODEC
+except ImportError:
+    from compressed_io import read_from_path, open_output, EXTENSION_TO_CODEC
+
+# data type -> (NEXUS DATATYPE, RAxML partition model)
+SUPPORTED_DATA_TYPES = {'dna': ('DNA', 'DNA'),
+                        'rna': ('RNA', 'DNA'),
+                        'protein': ('PROTEIN', 'WAG'),
+                       }
+_PLAIN_LABEL = re.compile(r'^[A-Za-z0-9.]+$')
+_NOT_NAME_CHAR = re.compile(r'[^A-Za-z0-9_.]')
+
+def gene_name(filepath):
+    '''Returns the name of the charset for the gene in `filepath`: the
+    filename without its compression suffix and extension, with any
+    character other than letters, digits, "_" and "." replaced by "_".
+    '''
+    fn = os.path.basename(filepath)
+    stem, ext = os.path.splitext(fn)
+    if ext.lower() in EXTENSION_TO_CODEC:
+        fn = stem
+    fn = os.path.splitext(fn)[0]
+    return _NOT_NAME_CHAR.sub('_', fn)
+
+def reduce_gene(char_mat, taxa_labels):
+    '''Returns (number of columns, dict of label -> sequence string) for the
+    rows of `char_mat` whose labels are in `taxa_labels`.
+    '''
+    by_label = {}
+    num_cols = None
+    for taxon in char_mat:
+        seq = char_mat[taxon].symbols_as_string()
+        if num_cols is None:
+            num_cols = len(seq)
+        elif len(seq) != num_cols:
+            raise ValueError('The sequence of "{}" has {} columns, expecting {}.\n'.format(taxon.label, len(seq), num_cols))
+        if taxon.label in taxa_labels:
+            by_label[taxon.label] = seq
+    return num_cols or 0, by_label
+
+def _reduce_gene_file(job):
+    '''Worker for `build_supermatrix`.'''
+    filepath, taxa_labels, char_type, schema, num_threads = job
+    char_mat = read_from_path(char_type, filepath, schema=schema, num_threads=num_threads)
+    try:
+        return reduce_gene(char_mat, taxa_labels)
+    except ValueError as x:
+        raise ValueError('"{}": {}'.format(filepath, str(x)))
+
+def _nexus_label(label):
+    if _PLAIN_LABEL.match(label):
+        return label
+    return "'{}'".format(label.replace("'", "''"))
+
+def _write_nexus(dest, body_stream, labels, num_cols, data_type):
+    dest.write('#NEXUS\n\nBEGIN DATA;\n')
+    dest.write('    DIMENSIONS NTAX={} NCHAR={};\n'.format(len(labels), num_cols))
+    dest.write('    FORMAT DATATYPE={} GAP=- MISSING=? INTERLEAVE=YES;\n'.format(SUPPORTED_DATA_TYPES[data_type][0]))
+    dest.write('MATRIX\n')
+    shutil.copyfileobj(body_stream, dest)
+    dest.write(';\nEND;\n')
+
+def _write_phylip(dest, body_stream, labels, num_cols, data_type):
+    dest.write('{} {}\n'.format(len(labels), num_cols))
+    shutil.copyfileobj(body_stream, dest)
+
+def _write_partitions(dest, partitions, data_type, partition_schema):
+    if partition_schema == 'nexus':
+        dest.write('#NEXUS\n\nBEGIN SETS;\n')
+        for name, first, last in partitions:
+            dest.write('    CHARSET {} = {}-{};\n'.format(name, first, last))
+        dest.write('END;\n')
+    else:
+        model = SUPPORTED_DATA_TYPES[data_type][1]
+        for name, first, last in partitions:
+            dest.write('{}, {} = {}-{}\n'.format(model, name, first, last))
+
+def _bounded_imap(pool, func, jobs, window):
+    '''Like `pool.imap(func, jobs)`, but with at most `window` jobs submitted
+    and not yet consumed, so that results that are ready before the earlier
+    ones have been written do not pile up in memory.
+    '''
+    pending = deque()
+    for job in jobs:
+        pending.append(pool.apply_async(func, (job,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def build_supermatrix(gene_filepaths,
+                      taxa_labels,
+                      output_filepath,
+                      partition_filepath,
+                      data_type='dna',
+                      schema='fasta',
+                      output_schema='nexus',
+                      partition_schema='nexus',
+                      num_workers=None):
+    '''Reduces each alignment in `gene_filepaths` to the taxa in
+    `taxa_labels` (in a pool of `num_workers` processes, default: one per
+    CPU) and writes their concatenation to `output_filepath` as an
+    interleaved "nexus" or "phylip" matrix (rows in the order of
+    `taxa_labels`), and the columns of each gene to `partition_filepath`
+    in "nexus" or "raxml" form.
+
+    Returns a dict of label -> the number of genes that had that taxon.
+    '''
+    import multiprocessing
+    if data_type not in SUPPORTED_DATA_TYPES:
+        k = sorted(SUPPORTED_DATA_TYPES.keys())
+        raise ValueError('The data type "{}" is not supported.\nExpecting one of "{}".\n'.format(data_type, '", "'.join(k)))
+    char_type = data_type_matrix_map[data_type]
+    if output_schema not in ('nexus', 'phylip'):
+        raise ValueError('The output schema "{}" is not supported.\nExpecting "nexus" or "phylip".\n'.format(output_schema))
+    if partition_schema not in ('nexus', 'raxml'):
+        raise ValueError('The partition schema "{}" is not supported.\nExpecting "nexus" or "raxml".\n'.format(partition_schema))
+    labels = []
+    for label in taxa_labels:
+        if label not in labels:
+            labels.append(label)
+    if output_schema == 'nexus':
+        padded = [_nexus_label(i) for i in labels]
+    else:
+        for label in labels:
+            if not label or re.search(r'\s', label):
+                raise ValueError('The label "{}" cannot be written in PHYLIP format.\n'.format(label))
+        padded = list(labels)
+    width = max(len(i) for i in padded) + 2 if padded else 0
+    padded = [i.ljust(width) for i in padded]
+    names = [gene_name(i) for i in gene_filepaths]
+    for name in names:
+        if names.count(name) > 1:
+            raise ValueError('More than one gene would have the charset name "{}".\n'.format(name))
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+    # compressed genes are decompressed on an equal share of the CPUs in each process
+    num_threads = max(multiprocessing.cpu_count()//num_workers, 1)
+    label_set = frozenset(labels)
+    jobs = [(fp, label_set, char_type, schema, num_threads) for fp in gene_filepaths]
+    num_genes_by_label = dict((i, 0) for i in labels)
+    partitions = []
+    num_cols = 0
+    # the blocks are written to a temporary file (in the output directory) until
+    # the total number of columns that goes in the header is known
+    out_dir = os.path.dirname(os.path.abspath(output_filepath))
+    with tempfile.TemporaryFile(mode='w+', dir=out_dir) as body:
+        pool = multiprocessing.Pool(num_workers)
+        try:
+            for name, (gene_cols, by_label) in zip(names, _bounded_imap(pool, _reduce_gene_file, jobs, 2*num_workers)):
+                if gene_cols == 0:
+                    continue
+                if partitions:
+                    body.write('\n')
+                missing = '?'*gene_cols
+                for label, prefix in zip(labels, padded):
+                    seq = by_label.get(label)
+                    if seq is None:
+                        seq = missing
+                    else:
+                        num_genes_by_label[label] += 1
+                    if output_schema == 'phylip' and partitions:
+                        prefix = ''
+                    body.write('{}{}\n'.format(prefix, seq))
+                partitions.append((name, num_cols + 1, num_cols + gene_cols))
+                num_cols += gene_cols
+        finally:
+            pool.close()
+            pool.join()
+        body.seek(0)
+        with open_output(output_filepath) as outp:
+            if output_schema == 'nexus':
+                _write_nexus(outp, body, padded, num_cols, data_type)
+            else:
+                _write_phylip(outp, body, padded, num_cols, data_type)
+    with open_output(partition_filepath) as outp:
+        _write_partitions(outp, partitions, data_type, partition_schema)
+    return num_genes_by_label
+
+def read_taxa_file(path):
+    '''Returns the labels in `path`, one per line (blank lines and lines
+    starting with # are ignored).'''
+    labels = []
+    with open(path, 'r') as inp:
+        for line in inp:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                labels.append(line)
+    return labels
+
+def _main(gene_filepaths,
+          taxa_labels,
+          output_filepath,
+          partition_filepath,
+          data_type_name='dna',
+          schema='fasta',
+          output_schema='nexus',
+          partition_schema='nexus',
+          num_workers=None):
+    dt = data_type_name.lower()
+    for ofp in [output_filepath, partition_filepath]:
+        if os.path.exists(ofp):
+            raise RuntimeError('"{}" already exists! Move it before running this script.\n'.format(ofp))
+    if not taxa_labels:
+        raise ValueError('No taxa were given.\n')
+    num_genes_by_label = build_supermatrix(gene_filepaths,
+                                           taxa_labels,
+                                           output_filepath,
+                                           partition_filepath,
+                                           data_type=dt,
+                                           schema=schema,
+                                           output_schema=output_schema.lower(),
+                                           partition_schema=partition_schema.lower(),
+                                           num_workers=num_workers)
+    absent = [label for label, n in num_genes_by_label.items() if n == 0]
+    if absent:
+        absent.sort()
+        sys.stderr.write('Taxa with no data in any gene: "{}"\n'.format('", "'.join(absent)))
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+    script_name = os.path.split(sys.argv[0])[1]
+    description = '''Takes many per-gene alignments and a set of taxa.
+Writes the concatenation of the alignments, reduced to those taxa (with missing data
+for taxa that are absent from a gene), as an interleaved matrix, and a partition
+file giving the columns of each gene.'''
+    parser = argparse.ArgumentParser(prog=script_name, description=description)
+    parser.add_argument('--data-type', default='dna', type=str, required=False, help='a data_type ("dna", "rna" or "protein"). Default is "dna"')
+    parser.add_argument('--schema', default='fasta', type=str, required=False, help='schema of the gene alignments. Default is "fasta"')
+    parser.add_argument('--taxa', default=None, type=str, required=True, help='filepath of the labels of the taxa to include, one per line')
+    parser.add_argument('--output', default=None, type=str, required=True, help='filepath for the supermatrix')
+    parser.add_argument('--output-schema', default='nexus', type=str, required=False, help='"nexus" or "phylip" (relaxed, interleaved). Default is "nexus"')
+    parser.add_argument('--partitions', default=None, type=str, required=True, help='filepath for the partition file')
+    parser.add_argument('--partition-schema', default='nexus', type=str, required=False, help='"nexus" (charsets) or "raxml". Default is "nexus"')
+    parser.add_argument('--num-workers', default=None, type=int, required=False, help='the number of worker processes. Default is the number of CPUs')
+    parser.add_argument('genes', nargs='+', help='filepaths of the gene alignments')
+    args = parser.parse_args(sys.argv[1:])
+    try:
+        _main(args.genes,
+              read_taxa_file(args.taxa),
+              args.output,
+              args.partitions,
+              data_type_name=args.data_type,
+              schema=args.schema,
+              output_schema=args.output_schema,
+              partition_schema=args.partition_schema,
+              num_workers=args.num_workers)
+    except Exception as x:
+        sys.exit('{}: {}\n'.format(script_name, str(x)))
@@ -4,24 +4,49 @@ if not report differences'''
 from dendropy import DnaCharacterMatrix, Tree
 from dendropy.datamodel.charmatrixmodel import data_type_matrix_map, \
                                                DnaCharacterMatrix
+try:
+    from dendrobites.compressed_io import read_from_path
+except ImportError:
+    from compressed_io import read_from_path
+try:
+    from dendrobites.compact_tree import CompactTree
+except ImportError:
+    from compact_tree import CompactTree
+try:
+    from dendrobites.reconcile_labels import apply_rename_map, \
+                                            read_rename_map, \
+                                            reconcile_labels, \
+                                            write_rename_map
+except ImportError:
+    from reconcile_labels import apply_rename_map, \
+                                 read_rename_map, \
+                                 reconcile_labels, \
+                                 write_rename_map
 
 def mutable_read_matrix_and_tree(char_file_path,
                                 tree_file_path,
                                 char_type=DnaCharacterMatrix,
                                 char_schema='fasta',
-                                tree_schema='newick'):
+                                tree_schema='newick',
+                                rename_map=None):
     '''Reads in tree and character matrix,
-    mutable namespace means names may not match'''
+    mutable namespace means names may not match.
+    The matrix taxa are relabeled by `rename_map` (if given) before
+    the tree is read.'''
     if char_file_path:
-        char_mat = char_type.get(path=char_file_path,
-                               schema=char_schema)
+        char_mat = read_from_path(char_type,
+                                  char_file_path,
+                                  schema=char_schema)
+        if rename_map:
+            apply_rename_map(char_mat.taxon_namespace, rename_map)
         # make the taxon_namespace mutable,
         # so that tree can be read even if different
         char_mat.taxon_namespace.is_mutable = True
-        tree = Tree.get(path=tree_file_path,
-                        schema=tree_schema,
-                        preserve_underscores=True,
-                        taxon_namespace=char_mat.taxon_namespace)
+        tree = read_from_path(Tree,
+                              tree_file_path,
+                              schema=tree_schema,
+                              preserve_underscores=True,
+                              taxon_namespace=char_mat.taxon_namespace)
     else:
         char_mat, tree = None, None
     return char_mat, tree
@@ -30,15 +55,28 @@ def tip_label_match(char_mat_filepath,
                             tree_filepath,
                             char_type=DnaCharacterMatrix,
                             char_schema='fasta',
-                            tree_schema='newick'):
+                            tree_schema='newick',
+                            compact_tree=False,
+                            rename_map=None):
     '''Reads a (required) CharacterMatrix from `char_mat_filepath`
     and a (required) tree from `tree_filepath` and
-    checks if tip labels match'''
+    checks if tip labels match.
+    If `compact_tree` is True, the (newick) tree is read as a CompactTree
+    and only its leaf labels are compared.
+    The matrix labels are relabeled by `rename_map` (if given) first.'''
+    if compact_tree:
+        return compact_tip_label_match(char_mat_filepath,
+                                       tree_filepath,
+                                       char_type=char_type,
+                                       char_schema=char_schema,
+                                       tree_schema=tree_schema,
+                                       rename_map=rename_map)
     char_mat, tree = mutable_read_matrix_and_tree(char_mat_filepath,
                                           tree_filepath,
                                           char_type=DnaCharacterMatrix,
                                           char_schema=char_schema,
-                                          tree_schema=tree_schema)
+                                          tree_schema=tree_schema,
+                                          rename_map=rename_map)
     treed_taxa = [i.taxon for i in tree.leaf_nodes()]
     if set(treed_taxa) != char_mat.poll_taxa():
         tree_missing = [i.label for i in char_mat.taxon_namespace if i not in treed_taxa]
@@ -57,13 +95,93 @@ def tip_label_match(char_mat_filepath,
     else:
         return 1
 
+def compact_tip_label_match(char_mat_filepath,
+                            tree_filepath,
+                            char_type=DnaCharacterMatrix,
+                            char_schema='fasta',
+                            tree_schema='newick',
+                            rename_map=None):
+    '''Like `tip_label_match`, but reads the tree as a CompactTree, which
+    takes much less memory than a dendropy Tree for very large trees.'''
+    mat_labels, tree_labels = read_labels(char_mat_filepath,
+                                          tree_filepath,
+                                          char_type=char_type,
+                                          char_schema=char_schema,
+                                          tree_schema=tree_schema,
+                                          rename_map=rename_map)
+    mat_label_set, tree_label_set = set(mat_labels), set(tree_labels)
+    if mat_label_set != tree_label_set:
+        tree_missing = [i for i in mat_labels if i not in tree_label_set]
+        emf = 'Some of the taxa in the matrix are not in the tree.\
+                Tree is missing "{}"\n'
+        em = emf.format('", "'.join(tree_missing))
+        sys.stderr.write(em)
+        mat_missing = []
+        for i in tree_labels:
+            if i not in mat_label_set and i not in mat_missing:
+                mat_missing.append(i)
+        emf = 'Some of the taxa in the tree are not in the data matrix.\
+                Matrix is missing "{}"\n'
+        em = emf.format('", "'.join(mat_missing))
+        sys.stderr.write(em)
+        return 0
+    else:
+        return 1
+
+def read_labels(char_mat_filepath,
+                tree_filepath,
+                char_type=DnaCharacterMatrix,
+                char_schema='fasta',
+                tree_schema='newick',
+                rename_map=None):
+    '''Returns (list of matrix taxon labels, list of tree leaf labels).
+    Newick trees are read as a CompactTree.'''
+    char_mat = read_from_path(char_type,
+                              char_mat_filepath,
+                              schema=char_schema)
+    if rename_map:
+        apply_rename_map(char_mat.taxon_namespace, rename_map)
+    mat_labels = [i.label for i in char_mat.taxon_namespace]
+    if tree_schema.lower() == 'newick':
+        tree = read_from_path(CompactTree, tree_filepath, schema=tree_schema)
+        tree_labels = tree.leaf_labels()
+    else:
+        tree = read_from_path(Tree, tree_filepath, schema=tree_schema, preserve_underscores=True)
+        tree_labels = [i.taxon.label for i in tree.leaf_node_iter() if i.taxon is not None]
+    return mat_labels, tree_labels
 
+def reconcile_tip_labels(char_mat_filepath,
+                         tree_filepath,
+                         char_type=DnaCharacterMatrix,
+                         char_schema='fasta',
+                         tree_schema='newick',
+                         rename_map=None,
+                         min_score=0.5):
+    '''Proposes a tree leaf label for each matrix label that is not in
+    the tree, chosen from the leaf labels that are not in the matrix
+    (see `reconcile_labels`).
+    Returns a list of (matrix label, tree label or None, similarity).'''
+    mat_labels, tree_labels = read_labels(char_mat_filepath,
+                                          tree_filepath,
+                                          char_type=char_type,
+                                          char_schema=char_schema,
+                                          tree_schema=tree_schema,
+                                          rename_map=rename_map)
+    mat_label_set, tree_label_set = set(mat_labels), set(tree_labels)
+    unmatched = [i for i in mat_labels if i not in tree_label_set]
+    candidates = set(i for i in tree_labels if i not in mat_label_set)
+    return reconcile_labels(unmatched, sorted(candidates), min_score=min_score)
 
 def _main(char_mat_filepath,
           tree_filepath,
           data_type_name,
           char_schema='fasta',
-          tree_schema='newick'):
+          tree_schema='newick',
+          compact_tree=False,
+          rename_map_filepath=None,
+          reconcile=False,
+          rename_map_out=None,
+          min_score=0.5):
     # Validate the data_type argument and use it to find the CharacterMatrix type
     dt = data_type_name.lower()
     mat_type = data_type_matrix_map.get(dt)
@@ -72,12 +190,32 @@ def _main(char_mat_filepath,
         k = data_type_matrix_map.keys()
         k.sort()
         raise ValueError(emf.format(u=data_type_name, t='", "'.join(k)))
+    rename_map = read_rename_map(rename_map_filepath) if rename_map_filepath else None
+    if reconcile:
+        proposals = reconcile_tip_labels(char_mat_filepath,
+                                         tree_filepath,
+                                         char_type=mat_type,
+                                         char_schema=char_schema,
+                                         tree_schema=tree_schema,
+                                         rename_map=rename_map,
+                                         min_score=min_score)
+        for mat_label, tree_label, score in proposals:
+            if tree_label is None:
+                sys.stdout.write('{}\t\t(no match)\n'.format(mat_label))
+            else:
+                sys.stdout.write('{}\t{}\t{:.3f}\n'.format(mat_label, tree_label, score))
+        if rename_map_out:
+            with open(rename_map_out, 'w') as outp:
+                write_rename_map([(m, t) for m, t, score in proposals if t is not None], outp)
+        return
     # read the char matrix and tree....
     match_check = tip_label_match(char_mat_filepath,
                     tree_filepath,
                     char_type=mat_type,
                     char_schema=char_schema,
-                    tree_schema=tree_schema)
+                    tree_schema=tree_schema,
+                    compact_tree=compact_tree,
+                    rename_map=rename_map)
     if match_check:
         sys.stdout.write("Tips match\n")
 
@@ -89,15 +227,30 @@ if __name__ == '__main__':
     import os
     script_name = os.path.split(sys.argv[0])[1]
     description = '''Takes a data file and a tree.
-    If taxon labels aren't matched, returns labels that are found in only one or the other.'''
+    If taxon labels aren't matched, returns labels that are found in only one or the other.
+    With --reconcile, proposes the most similar tree label for each matrix label that is not in the tree.'''
     parser = argparse.ArgumentParser(prog=script_name, description=description)
     parser.add_argument('--char', default=None, type=str, required=True, help='filepath of the character data')
     parser.add_argument('--tree', default=None, type=str, required=True, help='filepath of the tree')
     parser.add_argument('--char-schema', default="fasta", type=str, required=False, help='schema for the character data')
     parser.add_argument('--tree-schema', default="newick", type=str, required=False, help='schema for the tree')
     parser.add_argument('--data-type', default='dna', type=str, required=False, help='a data_type. Default is "dna"')
+    parser.add_argument('--compact-tree', action='store_true', default=False, help='hold the (newick) tree in a compact array-based form (for very large trees)')
+    parser.add_argument('--rename-map', default=None, type=str, required=False, help='filepath of a tab-separated map of old to new labels applied to the matrix while reading')
+    parser.add_argument('--reconcile', action='store_true', default=False, help='write a tab-separated list of each unmatched matrix label, the most similar unmatched tree label and their similarity')
+    parser.add_argument('--rename-map-out', default=None, type=str, required=False, help='with --reconcile, filepath for a rename map of the proposed matches (for --rename-map)')
+    parser.add_argument('--min-score', default=0.5, type=float, required=False, help='with --reconcile, the lowest similarity (0 to 1) of a proposed match. Default is 0.5')
     args = parser.parse_args(sys.argv[1:])
     try:
-        _main(args.char, args.tree, args.data_type, args.char_schema, args.tree_schema)
+        _main(args.char,
+              args.tree,
+              args.data_type,
+              args.char_schema,
+              args.tree_schema,
+              compact_tree=args.compact_tree,
+              rename_map_filepath=args.rename_map,
+              reconcile=args.reconcile,
+              rename_map_out=args.rename_map_out,
+              min_score=args.min_score)
     except Exception as x:
         sys.exit('{}: {}\n'.format(script_name, str(x)))
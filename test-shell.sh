@@ -7,14 +7,137 @@ dendrobites/induced_matrix_and_tree.py --char=data/A-Daminoacid.fas --tree=data/
 diff data/pruned-A-Dultrametric.tre test/expected/pruned-A-Dultrametric.tre || exit
 diff data/pruned-A-Daminoacid.fas test/expected/pruned-A-Daminoacid.fas || exit
 
+# induced_matrix_and_tree with compressed input and output
+rm -f test/output/A-Daminoacid.fas.gz test/output/A-Dultrametric.tre.gz test/output/pruned-A-Dultrametric.tre.gz test/output/pruned-A-Daminoacid.fas.gz
+gzip -c data/A-Daminoacid.fas > test/output/A-Daminoacid.fas.gz || exit
+gzip -c data/A-Dultrametric.tre > test/output/A-Dultrametric.tre.gz || exit
+dendrobites/induced_matrix_and_tree.py --char=test/output/A-Daminoacid.fas.gz --tree=test/output/A-Dultrametric.tre.gz  --data-type=protein A B C || exit
+gzip -dc test/output/pruned-A-Dultrametric.tre.gz | diff - test/expected/pruned-A-Dultrametric.tre || exit
+gzip -dc test/output/pruned-A-Daminoacid.fas.gz | diff - test/expected/pruned-A-Daminoacid.fas || exit
+
+# an output named .bgz is written as block-gzip
+rm -f test/output/A-Dultrametric.tre.bgz test/output/pruned-A-Dultrametric.tre.bgz
+gzip -c data/A-Dultrametric.tre > test/output/A-Dultrametric.tre.bgz || exit
+dendrobites/induced_matrix_and_tree.py --tree=test/output/A-Dultrametric.tre.bgz A B C || exit
+gzip -dc test/output/pruned-A-Dultrametric.tre.bgz | diff - test/expected/pruned-A-Dultrametric.tre || exit
+python -c "import sys; from dendrobites.compressed_io import BGZF_EOF; d = open(sys.argv[1], 'rb').read(); sys.exit(d[12:14] != b'BC' or not d.endswith(BGZF_EOF))" test/output/pruned-A-Dultrametric.tre.bgz || exit
+# and block-gzip input is read by inflating its blocks (on several threads)
+rm -f test/output/A-Dultrametric-bgzf.tre.bgz test/output/pruned-A-Dultrametric-bgzf.tre.bgz
+cp test/output/pruned-A-Dultrametric.tre.bgz test/output/A-Dultrametric-bgzf.tre.bgz || exit
+dendrobites/induced_matrix_and_tree.py --tree=test/output/A-Dultrametric-bgzf.tre.bgz A B C || exit
+gzip -dc test/output/pruned-A-Dultrametric-bgzf.tre.bgz | diff - test/expected/pruned-A-Dultrametric.tre || exit
+python -c "
+from dendrobites.compressed_io import open_input, open_output
+lines = ['{} {}\n'.format(i, 'ACGT'*(i % 50)) for i in range(100000)]
+with open_output('test/output/blocks.txt.bgz', num_threads=3) as outp:
+    outp.writelines(lines)
+with open_input('test/output/blocks.txt.bgz', num_threads=3) as inp:
+    assert list(inp) == lines
+" || exit
+
+# a malformed compressed input reports the parse error, not the exit status of the decompressor
+rm -f test/output/malformed.tre test/output/malformed.tre.xz test/output/pruned-malformed.tre.xz test/output/malformed-error
+python -c "import sys; sys.stdout.write('((A,B),(C,D)));\n' + '((A,B),(C,D));\n'*100000)" > test/output/malformed.tre || exit
+python -c "import lzma; lzma.open('test/output/malformed.tre.xz', 'wb').write(open('test/output/malformed.tre', 'rb').read())" || exit
+dendrobites/induced_matrix_and_tree.py --tree=test/output/malformed.tre.xz A B C 2> test/output/malformed-error && exit 1
+grep -q 'exited with status' test/output/malformed-error && exit 1
+grep -q 'Error parsing' test/output/malformed-error || exit
+
+# induced_matrix_and_tree with the single-pass pruning
+rm -f test/output/A-Dultrametric.tre test/output/pruned-A-Dultrametric.tre
+cp data/A-Dultrametric.tre test/output/A-Dultrametric.tre || exit
+dendrobites/induced_matrix_and_tree.py --tree=test/output/A-Dultrametric.tre --single-pass A B C || exit
+diff test/output/pruned-A-Dultrametric.tre test/expected/pruned-A-Dultrametric.tre || exit
+
+# induced_matrix_and_tree with the compact tree
+rm -f test/output/pruned-A-Dultrametric.tre
+dendrobites/induced_matrix_and_tree.py --tree=test/output/A-Dultrametric.tre --compact-tree A B C || exit
+diff test/output/pruned-A-Dultrametric.tre test/expected/pruned-A-Dultrametric.tre || exit
+
+# induced_matrix_and_tree keeps quoted underscores and the rooting token, with and without the compact tree
+rm -f test/output/apes-rooted.tre test/output/pruned-apes-rooted.tre
+cp test/apes-rooted.tre test/output/apes-rooted.tre || exit
+dendrobites/induced_matrix_and_tree.py --tree=test/output/apes-rooted.tre Homo_sapiens Pan_troglodytes Gorilla_gorilla || exit
+diff test/output/pruned-apes-rooted.tre test/expected/pruned-apes-rooted.tre || exit
+rm -f test/output/pruned-apes-rooted.tre
+dendrobites/induced_matrix_and_tree.py --tree=test/output/apes-rooted.tre --compact-tree Homo_sapiens Pan_troglodytes Gorilla_gorilla || exit
+diff test/output/pruned-apes-rooted.tre test/expected/pruned-apes-rooted.tre || exit
+
 # tip_match_correct
 rm -f test/output/tip-match-correct test/output/tip-match-error
 python dendrobites/tip_label_match.py --char data/A-Dnucleotide.fas --tree data/A-Dultrametric.tre > test/output/tip-match-correct || exit
 python dendrobites/tip_label_match.py --char data/A-Dnucleotide_label_error.fas --tree data/A-Dultrametric.tre 2> test/output/tip-match-error || exit
 diff test/output/tip-match-correct  test/expected/tip-match-correct || exit
 diff test/output/tip-match-error test/expected/tip-match-error || exit
+rm -f test/output/tip-match-correct test/output/tip-match-error
+python dendrobites/tip_label_match.py --compact-tree --char data/A-Dnucleotide.fas --tree data/A-Dultrametric.tre > test/output/tip-match-correct || exit
+python dendrobites/tip_label_match.py --compact-tree --char data/A-Dnucleotide_label_error.fas --tree data/A-Dultrametric.tre 2> test/output/tip-match-error || exit
+diff test/output/tip-match-correct  test/expected/tip-match-correct || exit
+diff test/output/tip-match-error test/expected/tip-match-error || exit
 
 # tip_match_correct
 rm -f test/output/paired-invariants-cull-output
 python dendrobites/paired_invariants_cull.py --p-inv=0.5 data/A-Dnucleotide.fas --schema=fasta  > test/output/paired-invariants-cull-output || exit
 diff test/output/paired-invariants-cull-output test/expected/paired-invariants-cull-output || exit
+
+# pipeline
+rm -f test/output/pipeline-pruned-A-Daminoacid.fas test/output/pipeline-pruned-A-Dultrametric.tre
+python dendrobites/pipeline.py test/pipeline-prune.json || exit
+diff test/output/pipeline-pruned-A-Dultrametric.tre test/expected/pruned-A-Dultrametric.tre || exit
+diff test/output/pipeline-pruned-A-Daminoacid.fas test/expected/pruned-A-Daminoacid.fas || exit
+
+# supermatrix
+rm -f test/output/supermatrix.nex test/output/supermatrix-partitions.nex
+python dendrobites/supermatrix.py --taxa test/supermatrix-taxa.txt --output test/output/supermatrix.nex --partitions test/output/supermatrix-partitions.nex data/A-Dnucleotide.fas data/tinymat.fas 2> /dev/null || exit
+diff test/output/supermatrix.nex test/expected/supermatrix.nex || exit
+diff test/output/supermatrix-partitions.nex test/expected/supermatrix-partitions.nex || exit
+
+# neighbor_joining: the least-squares placement on an edge agrees with a brute-force fit
+python test/check_ls_fit.py || exit
+
+# neighbor_joining: build an NJ tree for a subset of the taxa, then add the rest to it
+rm -f test/output/nj-subset.tre test/output/nj-extended.tre
+# (test/nj-subset.tre is a copy of the first tree with rounded edge lengths: the last digits
+# of the lengths of a new NJ tree vary from run to run)
+python dendrobites/neighbor_joining.py --output test/output/nj-subset.tre test/nj-subset.dist || exit
+python dendrobites/neighbor_joining.py --tree test/nj-subset.tre --output test/output/nj-extended.tre test/nj-full.dist || exit
+diff test/output/nj-extended.tre test/expected/nj-extended.tre || exit
+
+# tip_label_match --reconcile, then induced_matrix_and_tree with the rename map it wrote
+rm -f test/output/reconcile-proposals test/output/apes.map test/output/apes-rooted.tre test/output/pruned-apes-rooted.tre test/output/reconcile-apes.fas test/output/pruned-reconcile-apes.fas
+python dendrobites/tip_label_match.py --reconcile --rename-map-out test/output/apes.map --char test/reconcile-apes.fas --tree test/apes-rooted.tre > test/output/reconcile-proposals || exit
+diff test/output/reconcile-proposals test/expected/reconcile-proposals || exit
+diff test/output/apes.map test/expected/apes.map || exit
+cp test/apes-rooted.tre test/reconcile-apes.fas test/output/ || exit
+dendrobites/induced_matrix_and_tree.py --char=test/output/reconcile-apes.fas --tree=test/output/apes-rooted.tre --rename-map=test/output/apes.map Homo_sapiens Pan_troglodytes Gorilla_gorilla || exit
+diff test/output/pruned-apes-rooted.tre test/expected/pruned-apes-rooted.tre || exit
+diff test/output/pruned-reconcile-apes.fas test/expected/pruned-reconcile-apes.fas || exit
+# a rename map that would give two taxa the same label is rejected
+rm -f test/output/pruned-apes-rooted.tre test/output/pruned-reconcile-apes.fas
+printf 'homo sapiens\tGorilla_gorilla\n' > test/output/duplicate.map
+dendrobites/induced_matrix_and_tree.py --char=test/output/reconcile-apes.fas --tree=test/output/apes-rooted.tre --rename-map=test/output/duplicate.map Gorilla_gorilla 2> /dev/null && exit 1
+test ! -e test/output/pruned-apes-rooted.tre || exit
+
+# paired_invariants_cull of the loci in a manifest (with a global and a per-locus p_inv)
+rm -rf test/output/culled
+rm -f test/output/paired-invariants-cull-summary.tsv
+python dendrobites/paired_invariants_cull.py --schema=fasta --p-inv=0.5 --out-dir test/output/culled --summary test/output/paired-invariants-cull-summary.tsv --num-workers 2 test/cull-manifest.txt || exit
+diff test/output/paired-invariants-cull-summary.tsv test/expected/paired-invariants-cull-summary.tsv || exit
+diff test/output/culled/A-Dnucleotide.fas test/expected/paired-invariants-cull-output || exit
+diff test/output/culled/tinymat.fas test/expected/paired-invariants-cull-tinymat.fas || exit
+# two loci with the same filename would overwrite each other, so they are rejected
+rm -rf test/output/culled
+printf '../data/A-Dnucleotide.fas\n../test/output/culled-dup/A-Dnucleotide.fas\n' > test/output/cull-dup-manifest.txt
+mkdir -p test/output/culled-dup && cp data/A-Dnucleotide.fas test/output/culled-dup/ || exit
+python dendrobites/paired_invariants_cull.py --schema=fasta --p-inv=0.5 --out-dir test/output/culled test/output/cull-dup-manifest.txt > /dev/null 2>&1 && exit 1
+test ! -e test/output/culled/A-Dnucleotide.fas || exit
+
+# find_synapo_signal support statistics, streamed and as a top-k ranking (ties in column order)
+python dendrobites/find_synapo_signal.py --schema=fasta --char-mat data/A-Dnucleotide.fas --format tsv A B > test/output/synapo-stats.tsv || exit
+diff test/output/synapo-stats.tsv test/expected/synapo-stats.tsv || exit
+python dendrobites/find_synapo_signal.py --schema=fasta --char-mat data/A-Dnucleotide.fas --format json A B > test/output/synapo-stats.jsonl || exit
+diff test/output/synapo-stats.jsonl test/expected/synapo-stats.jsonl || exit
+python dendrobites/find_synapo_signal.py --schema=fasta --char-mat test/synapo-ties.fas --top-k 4 A B > test/output/synapo-top4.tsv || exit
+diff test/output/synapo-top4.tsv test/expected/synapo-top4.tsv || exit
+python dendrobites/find_synapo_signal.py --schema=fasta --char-mat test/synapo-ties.fas --top-k 2 --format json A B > test/output/synapo-top2.jsonl || exit
+diff test/output/synapo-top2.jsonl test/expected/synapo-top2.jsonl || exit
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+'''Checks the least-squares placement of neighbor_joining._ls_fit against
+a direct numerical minimization of the weighted sum of squared errors.
+'''
+import os
+import random
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from dendrobites.neighbor_joining import _ls_fit
+
+def sse(below, above, el, t, b):
+    return sum(w*(r - b - t)**2 for w, r in below) + sum(w*(r - b - el + t)**2 for w, r in above)
+
+def stats(leaves):
+    return (sum(w for w, r in leaves), sum(w*r for w, r in leaves), sum(w*r*r for w, r in leaves))
+
+def ternary_min(f, lo, hi):
+    for i in range(60):
+        m1, m2 = lo + (hi - lo)/3.0, hi - (hi - lo)/3.0
+        if f(m1) <= f(m2):
+            hi = m2
+        else:
+            lo = m1
+    return (lo + hi)/2.0
+
+def brute_force_fit(below, above, el):
+    b_max = max(abs(r) for w, r in below + above) + el + 1.0
+    best_b = lambda t: ternary_min(lambda b: sse(below, above, el, t, b), 0.0, b_max)
+    t = ternary_min(lambda t: sse(below, above, el, t, best_b(t)), 0.0, el)
+    b = best_b(t)
+    return sse(below, above, el, t, b), t, b
+
+def check(below, above, el):
+    fit_sse, t, b = _ls_fit(stats(below), stats(above), el)
+    bf_sse, bf_t, bf_b = brute_force_fit(below, above, el)
+    tol = 1e-6*max(1.0, bf_sse)
+    if not (0.0 <= t <= el and b >= 0.0):
+        sys.exit('_ls_fit{} gave t={}, b={} outside of the edge\n'.format((below, above, el), t, b))
+    if abs(fit_sse - sse(below, above, el, t, b)) > tol or abs(fit_sse - bf_sse) > tol:
+        sys.exit('_ls_fit{} gave SSE {} (t={}, b={}), brute force gives {} (t={}, b={})\n'.format((below, above, el), fit_sse, t, b, bf_sse, bf_t, bf_b))
+
+# the best attachment point is at the lower end of the edge
+check([(1.0, 1.0)], [(9.0, 5.0)], 1.0)
+rng = random.Random(1)
+for i in range(200):
+    below = [(rng.uniform(0.1, 10.0), rng.uniform(-2.0, 6.0)) for j in range(rng.randint(1, 4))]
+    above = [(rng.uniform(0.1, 10.0), rng.uniform(-2.0, 6.0)) for j in range(rng.randint(0, 4))]
+    check(below, above, rng.uniform(0.0, 3.0))